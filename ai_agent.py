@@ -1,11 +1,114 @@
 import google.generativeai as genai
 import os
 import re
+import json
+import time
+import threading
 import chromadb
 from chromadb.config import Settings
 from sentence_transformers import SentenceTransformer
 import numpy as np
 from typing import List, Dict, Any
+from knowledge_sync import KnowledgeSync
+from embedding_service import EmbeddingServiceClient, RemoteEmbeddingModel, RemoteCollection
+
+# Company knowledge documents seeded into the vector knowledge base
+SEED_KNOWLEDGE_DOCS = [
+    {
+        "id": "shipping_001",
+        "content": "We offer free shipping on all orders over $50. Standard shipping takes 3-5 business days within the continental US. Express shipping is available for $15 and takes 1-2 business days. International shipping is available to most countries and takes 7-14 business days.",
+        "category": "shipping",
+        "metadata": {"topic": "shipping_policy", "priority": "high"}
+    },
+    {
+        "id": "shipping_002", 
+        "content": "You can track your order using the tracking number provided in your shipping confirmation email. Visit our website and enter your tracking number in the order status page.",
+        "category": "shipping",
+        "metadata": {"topic": "tracking", "priority": "medium"}
+    },
+    {
+        "id": "returns_001",
+        "content": "We accept returns within 30 days of purchase for a full refund. Items must be in original condition with tags attached. Return shipping is free for defective items, otherwise customer pays return shipping costs.",
+        "category": "returns", 
+        "metadata": {"topic": "return_policy", "priority": "high"}
+    },
+    {
+        "id": "returns_002",
+        "content": "To initiate a return, log into your account and select the order you want to return. You can also contact customer service with your order number. We'll provide a prepaid return label for defective items.",
+        "category": "returns",
+        "metadata": {"topic": "return_process", "priority": "high"}
+    },
+    {
+        "id": "warranty_001",
+        "content": "All our products come with a 1-year manufacturer warranty covering defects in materials and workmanship. Electronics have a 2-year warranty. Warranty does not cover normal wear and tear or damage from misuse.",
+        "category": "warranty",
+        "metadata": {"topic": "warranty_terms", "priority": "medium"}
+    },
+    {
+        "id": "payment_001",
+        "content": "We accept all major credit cards (Visa, MasterCard, American Express, Discover), PayPal, Apple Pay, Google Pay, and bank transfers. All payments are processed securely using SSL encryption.",
+        "category": "payment",
+        "metadata": {"topic": "payment_methods", "priority": "medium"}
+    },
+    {
+        "id": "payment_002",
+        "content": "If your payment fails, please check that your card details are correct and you have sufficient funds. Contact your bank if the issue persists. You can also try a different payment method.",
+        "category": "payment", 
+        "metadata": {"topic": "payment_issues", "priority": "medium"}
+    },
+    {
+        "id": "support_001",
+        "content": "Our customer support team is available Monday through Friday, 9 AM to 5 PM EST. You can reach us via email at support@company.com or phone at 1-800-555-0123. Live chat is available on our website during business hours.",
+        "category": "support",
+        "metadata": {"topic": "contact_info", "priority": "high"}
+    },
+    {
+        "id": "products_001",
+        "content": "We offer a wide range of high-quality products including electronics, home goods, clothing, and accessories. All products go through rigorous quality testing before shipping.",
+        "category": "products",
+        "metadata": {"topic": "product_info", "priority": "low"}
+    },
+    {
+        "id": "account_001",
+        "content": "You can create an account on our website to track orders, save favorites, and speed up checkout. Account creation is free and your information is kept secure and private.",
+        "category": "account",
+        "metadata": {"topic": "account_management", "priority": "medium"}
+    }
+]
+
+# Extra keywords that route a question to the seed categories before vector
+# search. Every category in the collection is also routed by its own name.
+CATEGORY_KEYWORDS = {
+    "shipping": ["ship", "shipped", "deliver", "delivery", "tracking", "arrive", "courier", "where is my order"],
+    "returns": ["return", "exchange", "send back", "refund"],
+    "warranty": ["warranty", "guarantee", "defect", "defective", "broken", "repair"],
+    "payment": ["pay", "payment", "credit card", "debit card", "paypal", "billing", "charged", "invoice"],
+    "support": ["contact", "phone number", "opening hours", "live chat", "customer service"],
+    "products": ["in stock", "out of stock", "sizing"],
+    "account": ["login", "log in", "password", "sign up", "register", "profile"],
+}
+
+# Seconds between checks of the sync manifest for categories added by another
+# process (e.g. a bulk import)
+CATEGORY_REFRESH_SECONDS = 300
+
+# HNSW parameters chosen by `knowledge_manager.py benchmark --persist`
+HNSW_CONFIG_PATH = "./chroma_db/hnsw_config.json"
+
+def load_hnsw_config() -> Dict[str, Any]:
+    """HNSW construction/search parameters for new collections, if tuned"""
+    if not os.path.exists(HNSW_CONFIG_PATH):
+        return {}
+    with open(HNSW_CONFIG_PATH) as f:
+        return json.load(f)
+
+def save_hnsw_config(config: Dict[str, Any]):
+    os.makedirs(os.path.dirname(HNSW_CONFIG_PATH), exist_ok=True)
+    with open(HNSW_CONFIG_PATH, "w") as f:
+        json.dump(config, f, indent=2, sort_keys=True)
+
+# Higher priority documents win when similarities are (nearly) tied
+PRIORITY_RANK = {"high": 2, "medium": 1, "low": 0}
 
 class AIAgent:
     def __init__(self, db):
@@ -14,134 +117,79 @@ class AIAgent:
         self.model = genai.GenerativeModel('gemini-1.5-flash')
         self.db = db
         
-        # Initialize embedding model
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        collection_metadata = {"hnsw:space": "cosine", **load_hnsw_config()}
+        service_socket = os.getenv('EMBEDDING_SERVICE_SOCKET')
         
-        # Initialize ChromaDB
-        self.chroma_client = chromadb.PersistentClient(
-            path="./chroma_db",
-            settings=Settings(allow_reset=True, anonymized_telemetry=False)
+        if service_socket:
+            # Share one model and Chroma client with other processes via embedding_service.py
+            service = EmbeddingServiceClient(service_socket)
+            self.embedding_model = RemoteEmbeddingModel(service)
+            self.chroma_client = None
+            self.knowledge_collection = RemoteCollection(service, "knowledge_base", collection_metadata)
+        else:
+            # Initialize embedding model
+            self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+            
+            # Initialize ChromaDB
+            self.chroma_client = chromadb.PersistentClient(
+                path="./chroma_db",
+                settings=Settings(allow_reset=True, anonymized_telemetry=False)
+            )
+            
+            # Create or get knowledge base collection (HNSW parameters only apply on creation)
+            self.knowledge_collection = self.chroma_client.get_or_create_collection(
+                name="knowledge_base",
+                metadata=collection_metadata
+            )
+        self.knowledge_sync = KnowledgeSync(
+            self.knowledge_collection,
+            self.embedding_model,
+            manifest_path="./chroma_db/knowledge_manifest.json"
         )
         
-        # Create or get knowledge base collection
-        self.knowledge_collection = self.chroma_client.get_or_create_collection(
-            name="knowledge_base",
-            metadata={"hnsw:space": "cosine"}
-        )
+        self.category_lock = threading.Lock()
+        self.categories = set()  # knowledge base categories questions can be routed to
+        self.category_patterns = {}  # category -> compiled keyword regexes
+        self.manifest_mtime = None
         
         # Initialize knowledge base
         self.setup_knowledge_base()
+        
+        thread = threading.Thread(target=self._category_refresh_loop)
+        thread.daemon = True
+        thread.start()
     
     def setup_knowledge_base(self):
-        """Initialize the vector knowledge base with company information"""
-        
-        # Check if collection is already populated
-        if self.knowledge_collection.count() > 0:
-            print("Knowledge base already initialized")
-            return
+        """Sync the vector knowledge base with the seed company information
         
-        # Company knowledge documents
-        knowledge_docs = [
-            {
-                "id": "shipping_001",
-                "content": "We offer free shipping on all orders over $50. Standard shipping takes 3-5 business days within the continental US. Express shipping is available for $15 and takes 1-2 business days. International shipping is available to most countries and takes 7-14 business days.",
-                "category": "shipping",
-                "metadata": {"topic": "shipping_policy", "priority": "high"}
-            },
-            {
-                "id": "shipping_002", 
-                "content": "You can track your order using the tracking number provided in your shipping confirmation email. Visit our website and enter your tracking number in the order status page.",
-                "category": "shipping",
-                "metadata": {"topic": "tracking", "priority": "medium"}
-            },
-            {
-                "id": "returns_001",
-                "content": "We accept returns within 30 days of purchase for a full refund. Items must be in original condition with tags attached. Return shipping is free for defective items, otherwise customer pays return shipping costs.",
-                "category": "returns", 
-                "metadata": {"topic": "return_policy", "priority": "high"}
-            },
-            {
-                "id": "returns_002",
-                "content": "To initiate a return, log into your account and select the order you want to return. You can also contact customer service with your order number. We'll provide a prepaid return label for defective items.",
-                "category": "returns",
-                "metadata": {"topic": "return_process", "priority": "high"}
-            },
-            {
-                "id": "warranty_001",
-                "content": "All our products come with a 1-year manufacturer warranty covering defects in materials and workmanship. Electronics have a 2-year warranty. Warranty does not cover normal wear and tear or damage from misuse.",
-                "category": "warranty",
-                "metadata": {"topic": "warranty_terms", "priority": "medium"}
-            },
-            {
-                "id": "payment_001",
-                "content": "We accept all major credit cards (Visa, MasterCard, American Express, Discover), PayPal, Apple Pay, Google Pay, and bank transfers. All payments are processed securely using SSL encryption.",
-                "category": "payment",
-                "metadata": {"topic": "payment_methods", "priority": "medium"}
-            },
-            {
-                "id": "payment_002",
-                "content": "If your payment fails, please check that your card details are correct and you have sufficient funds. Contact your bank if the issue persists. You can also try a different payment method.",
-                "category": "payment", 
-                "metadata": {"topic": "payment_issues", "priority": "medium"}
-            },
-            {
-                "id": "support_001",
-                "content": "Our customer support team is available Monday through Friday, 9 AM to 5 PM EST. You can reach us via email at support@company.com or phone at 1-800-555-0123. Live chat is available on our website during business hours.",
-                "category": "support",
-                "metadata": {"topic": "contact_info", "priority": "high"}
-            },
-            {
-                "id": "products_001",
-                "content": "We offer a wide range of high-quality products including electronics, home goods, clothing, and accessories. All products go through rigorous quality testing before shipping.",
-                "category": "products",
-                "metadata": {"topic": "product_info", "priority": "low"}
-            },
-            {
-                "id": "account_001",
-                "content": "You can create an account on our website to track orders, save favorites, and speed up checkout. Account creation is free and your information is kept secure and private.",
-                "category": "account",
-                "metadata": {"topic": "account_management", "priority": "medium"}
-            }
-        ]
-        
-        # Generate embeddings and store in ChromaDB
-        documents = []
-        embeddings = []
-        ids = []
-        metadatas = []
-        
-        for doc in knowledge_docs:
-            # Generate embedding for the content
-            embedding = self.embedding_model.encode(doc["content"]).tolist()
-            
-            documents.append(doc["content"])
-            embeddings.append(embedding)
-            ids.append(doc["id"])
-            metadatas.append({
-                "category": doc["category"],
-                **doc["metadata"]
-            })
-        
-        # Add to ChromaDB collection
-        self.knowledge_collection.add(
-            documents=documents,
-            embeddings=embeddings,
-            ids=ids,
-            metadatas=metadatas
-        )
-        
-        print(f"Knowledge base initialized with {len(knowledge_docs)} documents")
+        Only documents whose content changed since the last sync are embedded.
+        """
+        stats = self.knowledge_sync.sync(SEED_KNOWLEDGE_DOCS, source="seed")
+        print(f"Knowledge base synced: {stats['added']} added, {stats['updated']} updated, "
+              f"{stats['unchanged']} unchanged, {stats['deleted']} deleted")
+        self.refresh_categories()
     
-    def semantic_search(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
-        """Perform semantic search using vector similarity"""
+    def semantic_search(self, query: str, top_k: int = 3, categories: List[str] = None,
+                        query_embedding: List[float] = None) -> List[Dict[str, Any]]:
+        """Perform semantic search using vector similarity
+        
+        categories restricts the search to documents of those categories.
+        Results are ordered by similarity, with document priority breaking ties.
+        """
         
         # Generate embedding for the query
-        query_embedding = self.embedding_model.encode(query).tolist()
+        if query_embedding is None:
+            query_embedding = self.embedding_model.encode(query).tolist()
+        
+        where = None
+        if categories:
+            where = {"category": categories[0]} if len(categories) == 1 else {"category": {"$in": categories}}
         
         # Search in ChromaDB
         results = self.knowledge_collection.query(
             query_embeddings=[query_embedding],
             n_results=top_k,
+            where=where,
             include=["documents", "metadatas", "distances"]
         )
         
@@ -155,8 +203,83 @@ class AIAgent:
                     "similarity_score": 1 - results['distances'][0][i]  # Convert distance to similarity
                 })
         
+        search_results.sort(
+            key=lambda doc: (
+                round(doc['similarity_score'], 2),
+                PRIORITY_RANK.get(doc['metadata'].get('priority'), 0)
+            ),
+            reverse=True
+        )
         return search_results
     
+    @staticmethod
+    def _category_patterns(categories) -> Dict[str, List[re.Pattern]]:
+        """Keyword regexes for each category
+        
+        Each category is matched by its name and the words of its name (so
+        "gift_cards" is routed by "gift card(s)", "gift(s)" and "card(s)"), plus its
+        CATEGORY_KEYWORDS entry if it has one.
+        """
+        patterns = {}
+        for category in sorted(categories):
+            words = [
+                # Singular form; the plural "s" is optional in the patterns below
+                word[:-1] if word.endswith('s') and not word.endswith('ss') else word
+                for word in re.split(r'[\W_]+', category.lower()) if len(word) > 2
+            ]
+            keywords = {" ".join(words), *words, *CATEGORY_KEYWORDS.get(category, [])}
+            patterns[category] = [
+                # Whole words only, allowing a plural "s"
+                re.compile(rf'\b{re.escape(keyword)}s?\b')
+                for keyword in keywords if keyword
+            ]
+        return patterns
+    
+    def add_categories(self, categories):
+        """Make newly added categories routable without reloading the rest"""
+        with self.category_lock:
+            if set(categories) <= self.categories:
+                return
+            self.categories = self.categories | set(categories)
+            self.category_patterns = self._category_patterns(self.categories)
+    
+    def refresh_categories(self):
+        """Reload the categories recorded in the sync manifest if it changed"""
+        try:
+            mtime = os.path.getmtime(self.knowledge_sync.manifest_path)
+        except OSError:
+            return
+        if mtime == self.manifest_mtime:
+            return
+        
+        categories = self.knowledge_sync.categories()
+        with self.category_lock:
+            self.categories = categories
+            self.category_patterns = self._category_patterns(categories)
+            self.manifest_mtime = mtime
+    
+    def _category_refresh_loop(self):
+        """Pick up categories synced or imported by other processes"""
+        while True:
+            time.sleep(CATEGORY_REFRESH_SECONDS)
+            try:
+                self.refresh_categories()
+            except Exception as e:
+                print(f"DEBUG - Could not reload knowledge base categories: {e}")
+    
+    def predict_categories(self, text: str) -> List[str]:
+        """Guess likely knowledge base categories from keywords, best match first"""
+        with self.category_lock:
+            patterns = self.category_patterns
+        
+        text = text.lower()
+        scores = {}
+        for category, category_patterns in patterns.items():
+            hits = sum(1 for pattern in category_patterns if pattern.search(text))
+            if hits:
+                scores[category] = hits
+        return sorted(scores, key=scores.get, reverse=True)
+    
     def generate_rag_response(self, question: str, context_docs: List[Dict[str, Any]]) -> str:
         """Generate response using RAG with Gemini"""
         
@@ -252,8 +375,39 @@ Response:"""
             print(f"DEBUG - Categorization error: {e}, defaulting to QUESTION")
             return 'QUESTION'  # Default to QUESTION for errors
     
-    def process_question(self, subject, body, sender, email_id, account):
-        """Enhanced question processing with RAG"""
+    def retrieve_context(self, question: str) -> List[Dict[str, Any]]:
+        """Find knowledge documents relevant enough to answer a question
+        
+        The search is first restricted to the categories predicted from the
+        question's keywords and only widened to the whole collection on a miss.
+        """
+        
+        query_embedding = self.embedding_model.encode(question).tolist()
+        categories = self.predict_categories(question)
+        
+        # Filter by similarity threshold (0.3 is fairly permissive)
+        relevant_docs = []
+        if categories:
+            relevant_docs = [
+                doc for doc in self.semantic_search(question, top_k=3, categories=categories,
+                                                    query_embedding=query_embedding)
+                if doc['similarity_score'] > 0.3
+            ]
+        
+        if not relevant_docs:
+            relevant_docs = [
+                doc for doc in self.semantic_search(question, top_k=3, query_embedding=query_embedding)
+                if doc['similarity_score'] > 0.3
+            ]
+        
+        return relevant_docs
+    
+    def process_question(self, subject, body, sender, email_id, account, relevant_docs=None):
+        """Enhanced question processing with RAG
+        
+        relevant_docs can be passed in when retrieval was already done, e.g. for
+        a near-duplicate of a recent email.
+        """
         
         # Combine subject and body for better context
         full_question = f"{subject} {body}".strip()
@@ -261,13 +415,9 @@ Response:"""
         print(f"Processing question with RAG: {subject}")
         
         # Step 1: Semantic search to find relevant documents
-        relevant_docs = self.semantic_search(full_question, top_k=3)
-        
-        # Filter by similarity threshold (0.3 is fairly permissive)
-        high_relevance_docs = [
-            doc for doc in relevant_docs 
-            if doc['similarity_score'] > 0.3
-        ]
+        if relevant_docs is None:
+            relevant_docs = self.retrieve_context(full_question)
+        high_relevance_docs = relevant_docs
         
         print(f"Found {len(high_relevance_docs)} relevant documents")
         for doc in high_relevance_docs:
@@ -286,34 +436,27 @@ Response:"""
         
         # No relevant information found - save as unhandled
         print("No relevant information found, saving as unhandled")
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            INSERT INTO unhandled_emails (email_id, sender_email, subject, body, category, importance)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (email_id, sender, subject, body, 'QUESTION', 'high'))
-        self.db.conn.commit()
-        cursor.close()
+        self.db.queue_unhandled_email(email_id, sender, subject, body, 'QUESTION', 'high', account)
         
         return None
     
     def add_knowledge_document(self, content: str, category: str, metadata: Dict[str, Any] = None):
-        """Add a new document to the knowledge base"""
-        
-        doc_id = f"{category}_{self.knowledge_collection.count() + 1:03d}"
-        embedding = self.embedding_model.encode(content).tolist()
+        """Add a new document to the knowledge base
         
-        doc_metadata = {"category": category}
-        if metadata:
-            doc_metadata.update(metadata)
+        The ID is derived from the content, so adding the same document twice
+        updates it in place instead of creating a duplicate.
+        """
         
-        self.knowledge_collection.add(
-            documents=[content],
-            embeddings=[embedding], 
-            ids=[doc_id],
-            metadatas=[doc_metadata]
+        doc_id = KnowledgeSync.document_id(category, content)
+        self.knowledge_sync.sync(
+            [{"id": doc_id, "content": content, "category": category, "metadata": metadata}],
+            source="manual",
+            prune=False
         )
+        self.add_categories([category])
         
         print(f"Added new knowledge document: {doc_id}")
+        return doc_id
     
     def process_refund(self, subject, body, sender, email_id, account):
         # Extract order ID from email
@@ -332,60 +475,30 @@ Best regards,
 Customer Support"""
             return response
         
-        order_id = matches[0]
-        
-        # Check if order exists
-        cursor = self.db.conn.cursor()
-        cursor.execute("SELECT id, refund_requested FROM orders WHERE order_id = %s", (order_id,))
-        result = cursor.fetchone()
+        # Handle every order mentioned, in order of appearance
+        order_ids = list(dict.fromkeys(matches))
+        found, missing = self.db.request_refunds(order_ids, sender, email_id, subject, body, account)
         
-        if result:
-            # Order found
-            cursor.execute(
-                "UPDATE orders SET refund_requested = TRUE WHERE order_id = %s",
-                (order_id,)
-            )
-            self.db.conn.commit()
-            cursor.close()
-            
-            response = f"""Hello,
-
-Your refund request for order {order_id} has been received and approved.
-
-The refund will be processed within 3 business days and will appear on your original payment method.
+        paragraphs = []
+        if found:
+            paragraphs.append(f"""Your refund request for order{'s' if len(found) > 1 else ''} {', '.join(found)} has been received and approved.
 
-Best regards,
-Customer Support"""
-            return response
-        else:
-            # Order not found - check if this is a repeat invalid ID
-            cursor.execute("""
-                SELECT COUNT(*) FROM not_found_refunds 
-                WHERE sender_email = %s AND attempted_order_id = %s
-            """, (sender, order_id))
-            
-            count = cursor.fetchone()[0]
-            
-            # Log the invalid request
-            cursor.execute("""
-                INSERT INTO not_found_refunds (email_id, sender_email, subject, body, attempted_order_id)
-                VALUES (%s, %s, %s, %s, %s)
-            """, (email_id, sender, subject, body, order_id))
-            
-            self.db.conn.commit()
-            cursor.close()
-            
-            response = f"""Hello,
+The refund will be processed within 3 business days and will appear on your original payment method.""")
+        if missing:
+            paragraphs.append(f"""We could not find order{'s' if len(missing) > 1 else ''} {', '.join(missing)} in our system. Please double-check your order ID and try again.
 
-We could not find order {order_id} in our system. Please double-check your order ID and try again.
+You can find your order ID in your purchase confirmation email.""")
+        
+        body_text = "\n\n".join(paragraphs)
+        response = f"""Hello,
 
-You can find your order ID in your purchase confirmation email.
+{body_text}
 
 Best regards,
 Customer Support"""
-            return response
+        return response
     
-    def process_other(self, subject, body, sender, email_id, account):
+    def assess_importance(self, subject, body):
         # Assess importance level using Gemini
         prompt = f"""
         Rate the importance of this email as: low, medium, high
@@ -410,13 +523,13 @@ Customer Support"""
         except:
             importance = 'low'
         
+        return importance
+    
+    def process_other(self, subject, body, sender, email_id, account, importance=None):
+        if importance is None:
+            importance = self.assess_importance(subject, body)
+        
         # Save to unhandled emails
-        cursor = self.db.conn.cursor()
-        cursor.execute("""
-            INSERT INTO unhandled_emails (email_id, sender_email, subject, body, category, importance)
-            VALUES (%s, %s, %s, %s, %s, %s)
-        """, (email_id, sender, subject, body, 'OTHER', importance))
-        self.db.conn.commit()
-        cursor.close()
+        self.db.queue_unhandled_email(email_id, sender, subject, body, 'OTHER', importance, account)
         
         return None  # No auto-reply for OTHER category
\ No newline at end of file
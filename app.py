@@ -52,13 +52,67 @@ def disconnect(email):
 
 @app.route('/start-processing')
 def start_processing():
-    email_processor.start_processing()
-    return jsonify({"status": "started"})
+    return jsonify({"status": email_processor.start_processing()})
 
 @app.route('/stop-processing')
 def stop_processing():
     email_processor.stop_processing()
     return jsonify({"status": "stopped"})
 
+@app.route('/processing-status')
+def processing_status():
+    return jsonify(email_processor.get_status())
+
+@app.route('/duplicate-stats')
+def duplicate_stats():
+    return jsonify(email_processor.duplicate_index.get_stats())
+
+def _page_args():
+    limit = min(max(request.args.get('limit', 50, type=int), 1), 200)
+    include_body = request.args.get('include_body', '').lower() in ('1', 'true', 'yes')
+    return limit, request.args.get('cursor'), include_body
+
+@app.route('/api/unhandled')
+def list_unhandled():
+    limit, cursor, include_body = _page_args()
+    try:
+        items, next_cursor = db.list_unhandled_emails(
+            limit=limit,
+            cursor=cursor,
+            category=request.args.get('category'),
+            account=request.args.get('account'),
+            importance=request.args.get('importance'),
+            include_body=include_body
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@app.route('/api/unhandled/<int:item_id>/resolve', methods=['POST'])
+def resolve_unhandled(item_id):
+    if not db.resolve_item('unhandled_emails', item_id):
+        return jsonify({"error": "not found or already resolved"}), 404
+    return jsonify({"status": "resolved", "id": item_id})
+
+@app.route('/api/not-found-refunds')
+def list_not_found_refunds():
+    limit, cursor, include_body = _page_args()
+    try:
+        items, next_cursor = db.list_not_found_refunds(
+            limit=limit,
+            cursor=cursor,
+            account=request.args.get('account'),
+            include_body=include_body
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    return jsonify({"items": items, "next_cursor": next_cursor})
+
+@app.route('/api/not-found-refunds/<int:item_id>/resolve', methods=['POST'])
+def resolve_not_found_refund(item_id):
+    if not db.resolve_item('not_found_refunds', item_id):
+        return jsonify({"error": "not found or already resolved"}), 404
+    return jsonify({"status": "resolved", "id": item_id})
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -1,100 +1,606 @@
 import psycopg2
+import psycopg2.extras
+import psycopg2.pool
 import os
+import json
+import fcntl
+import uuid
+import base64
+import atexit
+import select
+import threading
+import time
+from contextlib import contextmanager
 from datetime import datetime
+from migrations import MIGRATIONS
+
+def connection_params():
+    return {
+        "host": os.getenv('DB_HOST'),
+        "database": os.getenv('DB_NAME'),
+        "user": os.getenv('DB_USER'),
+        "password": os.getenv('DB_PASSWORD'),
+        "port": os.getenv('DB_PORT')
+    }
+
+def connect():
+    return psycopg2.connect(**connection_params())
+
+class OrderCache:
+    """In-process cache of which order IDs exist
+    
+    Entries are invalidated through Postgres LISTEN/NOTIFY on the
+    orders_changed channel, fed by a trigger on the orders table. The cache is
+    only consulted while the listener connection is up. Every notification
+    bumps an epoch; results are only stored if no notification was handled
+    since the query that produced them started, so a change racing a lookup
+    can never leave a stale entry behind.
+    """
+    
+    CHANNEL = 'orders_changed'
+    
+    def __init__(self):
+        self.known = {}  # order_id -> exists
+        self.epoch = 0
+        self.listening = False
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self._listen_loop)
+        thread.daemon = True
+        thread.start()
+    
+    def lookup(self, order_id):
+        """Return True/False if the order's existence is known, else None"""
+        with self.lock:
+            if not self.listening:
+                return None
+            return self.known.get(order_id)
+    
+    def current_epoch(self):
+        """Take before querying orders; pass to store() with the result"""
+        with self.lock:
+            return self.epoch
+    
+    def store(self, order_id, exists, epoch):
+        with self.lock:
+            if self.listening and self.epoch == epoch:
+                self.known[order_id] = exists
+    
+    def _listen_loop(self):
+        while True:
+            try:
+                conn = connect()
+                conn.autocommit = True
+                cursor = conn.cursor()
+                cursor.execute(f"LISTEN {self.CHANNEL}")
+                with self.lock:
+                    self.known.clear()
+                    self.epoch += 1
+                    self.listening = True
+                
+                while True:
+                    if select.select([conn], [], [], 30) == ([], [], []):
+                        continue
+                    conn.poll()
+                    with self.lock:
+                        while conn.notifies:
+                            notify = conn.notifies.pop(0)
+                            self.epoch += 1
+                            if notify.payload:
+                                self.known.pop(notify.payload, None)
+                            else:
+                                self.known.clear()
+            except Exception as e:
+                print(f"Order cache listener error: {e}")
+                with self.lock:
+                    self.listening = False
+                    self.epoch += 1
+                    self.known.clear()
+                time.sleep(5)
+
+class WriteBehindBuffer:
+    """Batches inserts into the history tables
+    
+    Rows are appended to a local journal file and flushed to Postgres with a
+    multi-row INSERT once max_rows are pending or max_delay seconds have
+    passed, on a dedicated connection. Each process journals to its own file
+    in journal_dir, held under an exclusive flock while the process lives.
+    On startup, journals whose lock is free belong to dead processes and are
+    replayed, so rows survive a crash between buffering and flushing.
+    """
+    
+    COLUMNS = {
+        'unhandled_emails': ('email_id', 'sender_email', 'subject', 'body', 'category', 'importance', 'account_email'),
+        'not_found_refunds': ('email_id', 'sender_email', 'subject', 'body', 'attempted_order_id', 'account_email'),
+    }
+    
+    def __init__(self, journal_dir='./write_behind', max_rows=100, max_delay=2.0):
+        self.journal_dir = journal_dir
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.pending = []  # (table, row)
+        self.conn = None
+        self.closed = False
+        self.lock = threading.Lock()  # guards pending and the journal
+        self.flush_lock = threading.Lock()  # one flush at a time
+        self.wakeup = threading.Condition(self.lock)
+        
+        # Claim this process's journal before writing to it
+        os.makedirs(journal_dir, exist_ok=True)
+        name = f"{os.getpid()}-{uuid.uuid4().hex[:12]}"
+        self.lock_file = open(os.path.join(journal_dir, f"{name}.lock"), 'w')
+        fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self.journal_path = os.path.join(journal_dir, f"{name}.jsonl")
+        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._recover()
+        
+        thread = threading.Thread(target=self._flush_loop)
+        thread.daemon = True
+        thread.start()
+        atexit.register(self.close)
+    
+    def add(self, table, row):
+        if table not in self.COLUMNS:
+            raise ValueError(f"Unknown write-behind table: {table}")
+        with self.lock:
+            self.pending.append((table, tuple(row)))
+            self._journal_write(table, row)
+            self.journal.flush()
+            if len(self.pending) >= self.max_rows:
+                self.wakeup.notify()
+    
+    def flush(self):
+        """Write all pending rows to the database"""
+        flushing_path = f"{self.journal_path}.flushing"
+        with self.flush_lock:
+            with self.lock:
+                # Start a fresh journal; the old one is kept until the batch commits.
+                # Rows are only taken once the rotation has succeeded.
+                try:
+                    self.journal.close()
+                    if os.path.exists(flushing_path):
+                        with open(flushing_path, 'a', encoding='utf-8') as older, \
+                                open(self.journal_path, encoding='utf-8') as current:
+                            older.write(current.read())
+                    else:
+                        os.replace(self.journal_path, flushing_path)
+                    self.journal = open(self.journal_path, 'w', encoding='utf-8')
+                except OSError:
+                    if self.journal.closed:
+                        self.journal = open(self.journal_path, 'a', encoding='utf-8')
+                    raise
+                batch = self.pending
+                self.pending = []
+            
+            if not batch:
+                os.remove(flushing_path)
+                return 0
+            
+            try:
+                self._insert(batch)
+            except Exception as e:
+                print(f"Write-behind flush failed, will retry: {e}")
+                with self.lock:
+                    self.pending = batch + self.pending
+                if self.conn is not None:
+                    try:
+                        self.conn.close()
+                    except Exception:
+                        pass
+                    self.conn = None
+                return 0
+            
+            os.remove(flushing_path)
+            return len(batch)
+    
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self.flush()
+        except OSError as e:
+            print(f"Write-behind flush on close failed, rows stay in {self.journal_dir}: {e}")
+        with self.lock:
+            self.closed = True
+            self.wakeup.notify()
+            self.journal.close()
+        if self.conn is not None:
+            self.conn.close()
+        
+        # Release the journal; anything left in it is recovered by the next start
+        if not self.pending and not os.path.exists(f"{self.journal_path}.flushing"):
+            for path in (self.journal_path, self.lock_file.name):
+                if os.path.exists(path):
+                    os.remove(path)
+        self.lock_file.close()
+    
+    def _insert(self, batch):
+        if self.conn is None or self.conn.closed:
+            self.conn = connect()
+        
+        by_table = {}
+        for table, row in batch:
+            # Rows journalled before a column was added are padded with NULLs
+            row = row + (None,) * (len(self.COLUMNS[table]) - len(row))
+            by_table.setdefault(table, []).append(row)
+        
+        cursor = self.conn.cursor()
+        try:
+            for table, rows in by_table.items():
+                columns = ', '.join(self.COLUMNS[table])
+                psycopg2.extras.execute_values(
+                    cursor,
+                    f"INSERT INTO {table} ({columns}) VALUES %s",
+                    rows,
+                    page_size=len(rows)
+                )
+            self.conn.commit()
+        except Exception:
+            self.conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                if self.closed:
+                    return
+                if len(self.pending) < self.max_rows:
+                    self.wakeup.wait(self.max_delay)
+                if self.closed:
+                    return
+                has_rows = bool(self.pending)
+            if has_rows:
+                try:
+                    self.flush()
+                except Exception as e:
+                    print(f"Write-behind flush error, will retry: {e}")
+    
+    def _journal_write(self, table, row):
+        self.journal.write(json.dumps([table, list(row)]) + "\n")
+    
+    def _recover(self):
+        """Load rows left by dead processes that never reached the database"""
+        for name in sorted(os.listdir(self.journal_dir)):
+            if not name.endswith('.lock'):
+                continue
+            lock_path = os.path.join(self.journal_dir, name)
+            try:
+                lock_file = open(lock_path, 'a')
+            except OSError:
+                continue  # recovered by another process meanwhile
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock_file.close()
+                continue  # owner is still running
+            
+            try:
+                recovered_elsewhere = os.stat(lock_path).st_ino != os.fstat(lock_file.fileno()).st_ino
+            except FileNotFoundError:
+                recovered_elsewhere = True
+            if recovered_elsewhere:
+                # Another process starting at the same time recovered and removed it first
+                lock_file.close()
+                continue
+            
+            journal_path = lock_path[:-len('.lock')] + '.jsonl'
+            recovered = 0
+            for path in (f"{journal_path}.flushing", journal_path):
+                if not os.path.exists(path):
+                    continue
+                with open(path, encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            table, row = json.loads(line)
+                        except ValueError:
+                            continue  # torn final line from a crash
+                        self.pending.append((table, tuple(row)))
+                        self._journal_write(table, row)
+                        recovered += 1
+                # Rows are in our own journal before the orphaned one is removed
+                self.journal.flush()
+                os.remove(path)
+            try:
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+            lock_file.close()
+            if recovered:
+                print(f"Recovered {recovered} buffered rows from {journal_path}")
 
 class Database:
+    MIGRATION_LOCK_ID = 7301
+    API_POOL_SIZE = 10  # connections for concurrent triage API requests
+    
     def __init__(self):
-        self.conn = psycopg2.connect(
-            host=os.getenv('DB_HOST'),
-            database=os.getenv('DB_NAME'),
-            user=os.getenv('DB_USER'),
-            password=os.getenv('DB_PASSWORD'),
-            port=os.getenv('DB_PORT')
-        )
-        self.create_tables()
+        self.conn = connect()
+        self.retention_days = int(os.getenv('PROCESSED_EMAILS_RETENTION_DAYS', '30'))
+        self.read_only_orders = False  # look up orders without flagging refunds (replay dry runs)
+        self.migrate()
+        self.order_cache = OrderCache()
+        self.write_buffer = WriteBehindBuffer()
+        self.api_pool = None
+        self.api_pool_lock = threading.Lock()
+    
+    @contextmanager
+    def api_connection(self):
+        """A pooled connection for triage API requests
+        
+        Commits or rolls back only its own transaction, never one the fetch
+        loop or workers have open on the shared conn.
+        """
+        with self.api_pool_lock:
+            if self.api_pool is None:
+                self.api_pool = psycopg2.pool.ThreadedConnectionPool(
+                    1, self.API_POOL_SIZE, **connection_params()
+                )
+        
+        conn = self.api_pool.getconn()
+        try:
+            yield conn
+            conn.commit()
+        except Exception:
+            if not conn.closed:
+                conn.rollback()
+            raise
+        finally:
+            self.api_pool.putconn(conn, close=bool(conn.closed))
     
-    def create_tables(self):
+    def migrate(self):
+        """Apply pending schema migrations
+        
+        Once the schema is current, startup only looks up the schema version
+        and runs no DDL.
+        """
         cursor = self.conn.cursor()
+        cursor.execute("SELECT to_regclass('schema_migrations')")
+        if cursor.fetchone()[0] is None:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            self.conn.commit()
+            current = 0
+        else:
+            cursor.execute("SELECT COALESCE(MAX(version), 0) FROM schema_migrations")
+            current = cursor.fetchone()[0]
         
-        # Orders table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id SERIAL PRIMARY KEY,
-                order_id VARCHAR(255) UNIQUE NOT NULL,
-                customer_email VARCHAR(255) NOT NULL,
-                amount DECIMAL(10, 2),
-                status VARCHAR(50) DEFAULT 'completed',
-                refund_requested BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Unhandled emails table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS unhandled_emails (
-                id SERIAL PRIMARY KEY,
-                email_id VARCHAR(255) NOT NULL,
-                sender_email VARCHAR(255) NOT NULL,
-                subject VARCHAR(500),
-                body TEXT,
-                category VARCHAR(50),
-                importance VARCHAR(20),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Not found refund requests table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS not_found_refunds (
-                id SERIAL PRIMARY KEY,
-                email_id VARCHAR(255) NOT NULL,
-                sender_email VARCHAR(255) NOT NULL,
-                subject VARCHAR(500),
-                body TEXT,
-                attempted_order_id VARCHAR(255),
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Gmail accounts table
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS gmail_accounts (
-                id SERIAL PRIMARY KEY,
-                email VARCHAR(255) UNIQUE NOT NULL,
-                access_token TEXT,
-                refresh_token TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        
-        # Email processing history
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS processed_emails (
-                id SERIAL PRIMARY KEY,
-                email_id VARCHAR(255) UNIQUE NOT NULL,
-                processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+        for version, description, statements in MIGRATIONS:
+            if version <= current:
+                continue
+            
+            # Serialize with other processes starting at the same time
+            cursor.execute("SELECT pg_advisory_xact_lock(%s)", (self.MIGRATION_LOCK_ID,))
+            cursor.execute("SELECT 1 FROM schema_migrations WHERE version = %s", (version,))
+            if cursor.fetchone():
+                self.conn.commit()
+                continue
+            
+            print(f"Applying migration {version}: {description}")
+            try:
+                for statement in statements:
+                    cursor.execute(statement)
+                cursor.execute(
+                    "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                    (version, description)
+                )
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                cursor.close()
+                raise
         
-        self.conn.commit()
+        self.conn.commit()  # end the version lookup's transaction
         cursor.close()
-        
-        # Insert sample orders for testing
-        self.insert_sample_data()
     
-    def insert_sample_data(self):
-        cursor = self.conn.cursor()
-        sample_orders = [
-            ('ORD001', 'customer1@example.com', 99.99),
-            ('ORD002', 'customer2@example.com', 149.50),
-            ('ORD003', 'customer3@example.com', 75.00),
-        ]
+    def prune_processed_emails(self, batch_size=5000):
+        """Delete processing history older than the retention period
         
-        for order_id, email, amount in sample_orders:
+        Deletes in batches so a large backlog never holds long locks. Gmail is
+        only polled for mail newer than the retention period, so pruned
+        messages are never picked up again.
+        """
+        cursor = self.conn.cursor()
+        deleted = 0
+        while True:
             cursor.execute("""
-                INSERT INTO orders (order_id, customer_email, amount) 
-                VALUES (%s, %s, %s) ON CONFLICT (order_id) DO NOTHING
-            """, (order_id, email, amount))
+                DELETE FROM processed_emails WHERE id IN (
+                    SELECT id FROM processed_emails
+                    WHERE processed_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+                    LIMIT %s
+                )
+            """, (self.retention_days, batch_size))
+            self.conn.commit()
+            deleted += cursor.rowcount
+            if cursor.rowcount < batch_size:
+                break
+        cursor.close()
         
+        if deleted:
+            print(f"Pruned {deleted} processed emails older than {self.retention_days} days")
+        return deleted
+    
+    def release_processed_emails(self, email_ids):
+        """Forget that emails were fetched, so the next poll picks them up again"""
+        cursor = self.conn.cursor()
+        cursor.execute("DELETE FROM processed_emails WHERE email_id = ANY(%s)", (list(email_ids),))
         self.conn.commit()
-        cursor.close()
\ No newline at end of file
+        cursor.close()
+    
+    def request_refunds(self, order_ids, sender, email_id, subject, body, account=None):
+        """Flag refunds for existing orders and log the unknown order IDs
+        
+        Existing orders get refund_requested set in a single UPDATE ...
+        RETURNING; the rest are queued for not_found_refunds through the
+        write-behind buffer. Orders the cache already knows to be missing
+        never touch the database synchronously. With read_only_orders the
+        orders are only looked up, not flagged. Returns (found_ids, missing_ids).
+        """
+        candidates = [oid for oid in order_ids if self.order_cache.lookup(oid) is not False]
+        epoch = self.order_cache.current_epoch()
+        
+        updated = set()
+        if candidates:
+            cursor = self.conn.cursor()
+            try:
+                if self.read_only_orders:
+                    cursor.execute("SELECT order_id FROM orders WHERE order_id = ANY(%s)", (candidates,))
+                else:
+                    cursor.execute("""
+                        UPDATE orders SET refund_requested = TRUE
+                        WHERE order_id = ANY(%s)
+                        RETURNING order_id
+                    """, (candidates,))
+                updated = {row[0] for row in cursor.fetchall()}
+                self.conn.commit()
+            except Exception:
+                # Don't leave the shared connection in an aborted transaction
+                self.conn.rollback()
+                raise
+            finally:
+                cursor.close()
+        
+        for order_id in candidates:
+            self.order_cache.store(order_id, order_id in updated, epoch)
+        
+        found = [oid for oid in order_ids if oid in updated]
+        missing = [oid for oid in order_ids if oid not in updated]
+        for order_id in missing:
+            self.write_buffer.add(
+                'not_found_refunds',
+                (email_id, sender, subject, body, order_id, account)
+            )
+        return found, missing
+    
+    def queue_unhandled_email(self, email_id, sender, subject, body, category, importance, account=None):
+        """Record an email for manual handling via the write-behind buffer"""
+        self.write_buffer.add(
+            'unhandled_emails',
+            (email_id, sender, subject, body, category, importance, account)
+        )
+    
+    @staticmethod
+    def encode_cursor(values):
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+    
+    @staticmethod
+    def decode_cursor(cursor):
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        except (ValueError, TypeError):
+            raise ValueError("Invalid cursor")
+        if not isinstance(key, list):
+            raise ValueError("Invalid cursor")
+        return key
+    
+    @staticmethod
+    def _parse_key_value(column, value):
+        """Check a cursor value has the type of its key column"""
+        if column == 'created_at':
+            if isinstance(value, str):
+                try:
+                    return datetime.fromisoformat(value)
+                except ValueError:
+                    pass
+        elif isinstance(value, int) and not isinstance(value, bool):
+            return value
+        raise ValueError("Invalid cursor")
+    
+    def _fetch_page(self, table, columns, key_columns, filters, limit, cursor):
+        """Run a keyset-paginated query over open (unresolved) rows
+        
+        Rows are ordered by key_columns descending; cursor holds the key of
+        the last row of the previous page, so each page is an index range
+        scan no matter how deep it is.
+        """
+        where = ["resolved_at IS NULL"]
+        params = []
+        for column, value in filters.items():
+            if value is not None:
+                where.append(f"{column} = %s")
+                params.append(value)
+        if cursor:
+            key = self.decode_cursor(cursor)
+            if len(key) != len(key_columns):
+                raise ValueError("Invalid cursor")
+            where.append(f"({', '.join(key_columns)}) < ({', '.join(['%s'] * len(key))})")
+            params.extend(
+                self._parse_key_value(column, value)
+                for column, value in zip(key_columns, key)
+            )
+        
+        order = ', '.join(f"{column} DESC" for column in key_columns)
+        with self.api_connection() as conn:
+            db_cursor = conn.cursor()
+            try:
+                db_cursor.execute(f"""
+                    SELECT {', '.join(columns)} FROM {table}
+                    WHERE {' AND '.join(where)}
+                    ORDER BY {order}
+                    LIMIT %s
+                """, params + [limit + 1])
+                rows = db_cursor.fetchall()
+            finally:
+                db_cursor.close()
+        
+        items = []
+        for row in rows[:limit]:
+            item = dict(zip(columns, row))
+            if item.get('created_at') is not None:
+                item['created_at'] = item['created_at'].isoformat()
+            items.append(item)
+        
+        next_cursor = None
+        if len(rows) > limit:
+            last = items[-1]
+            next_cursor = self.encode_cursor([last[column] for column in key_columns])
+        return items, next_cursor
+    
+    def list_unhandled_emails(self, limit=50, cursor=None, category=None, account=None,
+                              importance=None, include_body=False):
+        """Page through open unhandled emails, most important and newest first"""
+        columns = ['id', 'email_id', 'sender_email', 'account_email', 'subject',
+                   'category', 'importance', 'importance_rank', 'created_at']
+        if include_body:
+            columns.append('body')
+        return self._fetch_page(
+            'unhandled_emails',
+            columns,
+            ['importance_rank', 'created_at', 'id'],
+            {'category': category, 'account_email': account, 'importance': importance},
+            limit,
+            cursor
+        )
+    
+    def list_not_found_refunds(self, limit=50, cursor=None, account=None, include_body=False):
+        """Page through open not-found refund attempts, newest first"""
+        columns = ['id', 'email_id', 'sender_email', 'account_email', 'subject',
+                   'attempted_order_id', 'created_at']
+        if include_body:
+            columns.append('body')
+        return self._fetch_page(
+            'not_found_refunds',
+            columns,
+            ['created_at', 'id'],
+            {'account_email': account},
+            limit,
+            cursor
+        )
+    
+    def resolve_item(self, table, item_id):
+        """Mark an unhandled email or not-found refund as resolved"""
+        with self.api_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(f"""
+                    UPDATE {table} SET resolved_at = CURRENT_TIMESTAMP
+                    WHERE id = %s AND resolved_at IS NULL
+                    RETURNING id
+                """, (item_id,))
+                return cursor.fetchone() is not None
+            finally:
+                cursor.close()
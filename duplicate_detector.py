@@ -0,0 +1,165 @@
+import re
+import time
+import zlib
+import random
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, Tuple
+
+# Mersenne prime used for the universal hash family
+_PRIME = (1 << 61) - 1
+_MAX_HASH = (1 << 32) - 1
+
+
+class NearDuplicateIndex:
+    """Bounded MinHash/LSH index of recently processed emails.
+
+    Campaign-style floods ("where is my order?") produce many emails with
+    near-identical text. Each processed email is stored with its outcome
+    (category, retrieved documents, importance) so that a near-duplicate can
+    reuse it instead of calling Gemini and the embedding model again.
+    """
+
+    def __init__(self, num_perm: int = 64, bands: int = 16, threshold: float = 0.8,
+                 shingle_size: int = 3, capacity: int = 2000, ttl_seconds: int = 6 * 3600):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be divisible by bands")
+
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.capacity = capacity
+        self.ttl_seconds = ttl_seconds
+
+        # Fixed seed keeps signatures stable across restarts
+        rng = random.Random(1)
+        self._perms = [
+            (rng.randrange(1, _PRIME), rng.randrange(0, _PRIME))
+            for _ in range(num_perm)
+        ]
+
+        self._entries = OrderedDict()  # email_id -> entry, oldest first
+        self._buckets = {}  # (band, band_hash) -> set of email_ids
+        self._lock = threading.Lock()
+
+        self.stats = {
+            "lookups": 0,
+            "hits": 0,
+            "llm_calls_saved": 0,
+            "embedding_calls_saved": 0,
+        }
+
+    @staticmethod
+    def normalize(subject: str, body: str) -> str:
+        """Lowercase, drop reply prefixes and mask numbers such as order IDs"""
+        subject = re.sub(r'^\s*((re|fwd?)\s*:\s*)+', '', subject or '', flags=re.IGNORECASE)
+        text = f"{subject} {body or ''}".lower()
+        text = re.sub(r'\d+', '0', text)
+        text = re.sub(r'[^\w\s]', ' ', text)
+        return re.sub(r'\s+', ' ', text).strip()
+
+    def _shingles(self, text: str) -> set:
+        words = text.split()
+        if len(words) < self.shingle_size:
+            return {" ".join(words)} if words else set()
+        return {
+            " ".join(words[i:i + self.shingle_size])
+            for i in range(len(words) - self.shingle_size + 1)
+        }
+
+    def signature(self, subject: str, body: str) -> Optional[Tuple[int, ...]]:
+        """Compute the MinHash signature of an email, or None if it has no text"""
+        shingles = self._shingles(self.normalize(subject, body))
+        if not shingles:
+            return None
+
+        hashes = [zlib.crc32(s.encode('utf-8')) for s in shingles]
+        return tuple(
+            min(((a * h + b) % _PRIME) & _MAX_HASH for h in hashes)
+            for a, b in self._perms
+        )
+
+    def _band_keys(self, signature: Tuple[int, ...]) -> List[Tuple[int, int]]:
+        return [
+            (band, hash(signature[band * self.rows:(band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    @staticmethod
+    def similarity(sig_a: Tuple[int, ...], sig_b: Tuple[int, ...]) -> float:
+        """Estimate Jaccard similarity from two signatures"""
+        return sum(1 for a, b in zip(sig_a, sig_b) if a == b) / len(sig_a)
+
+    def find(self, signature: Optional[Tuple[int, ...]]) -> Optional[Dict[str, Any]]:
+        """Return the outcome of the most similar recent email, if any"""
+        if signature is None:
+            return None
+
+        with self._lock:
+            self.stats["lookups"] += 1
+            self._expire()
+
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates.update(self._buckets.get(key, ()))
+
+            best_id, best_score = None, 0.0
+            for email_id in candidates:
+                score = self.similarity(signature, self._entries[email_id]["signature"])
+                if score > best_score:
+                    best_id, best_score = email_id, score
+
+            if best_id is None or best_score < self.threshold:
+                return None
+
+            self.stats["hits"] += 1
+            entry = self._entries[best_id]
+            return {"email_id": best_id, "similarity": best_score, **entry["outcome"]}
+
+    def add(self, email_id: str, signature: Optional[Tuple[int, ...]], outcome: Dict[str, Any]):
+        """Remember the outcome of a freshly processed email"""
+        if signature is None:
+            return
+
+        with self._lock:
+            if email_id in self._entries:
+                self._remove(email_id)
+
+            self._entries[email_id] = {
+                "signature": signature,
+                "outcome": outcome,
+                "added_at": time.time(),
+            }
+            for key in self._band_keys(signature):
+                self._buckets.setdefault(key, set()).add(email_id)
+
+            while len(self._entries) > self.capacity:
+                self._remove(next(iter(self._entries)))
+
+    def record_savings(self, llm_calls: int = 0, embedding_calls: int = 0):
+        with self._lock:
+            self.stats["llm_calls_saved"] += llm_calls
+            self.stats["embedding_calls_saved"] += embedding_calls
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self.stats, "size": len(self._entries)}
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl_seconds
+        while self._entries:
+            email_id, entry = next(iter(self._entries.items()))
+            if entry["added_at"] >= cutoff:
+                break
+            self._remove(email_id)
+
+    def _remove(self, email_id: str):
+        entry = self._entries.pop(email_id)
+        for key in self._band_keys(entry["signature"]):
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(email_id)
+                if not bucket:
+                    del self._buckets[key]
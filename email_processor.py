@@ -1,61 +1,204 @@
 import time
+import queue
 import threading
+from datetime import datetime
+from duplicate_detector import NearDuplicateIndex
 
 class EmailProcessor:
+    POLL_INTERVAL = 30  # seconds between inbox checks
+    ERROR_BACKOFF = 60  # seconds to wait after a failed poll
+    MAX_BACKLOG = 50  # fetching pauses while this many emails wait to be processed
+    WORKERS = 2  # emails processed concurrently
+    
     def __init__(self, db, gmail_client, ai_agent):
         self.db = db
         self.gmail_client = gmail_client
         self.ai_agent = ai_agent
-        self.running = False
+        self.last_prune = 0
+        self.duplicate_index = NearDuplicateIndex()
+        
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.backlog = queue.Queue()  # emails waiting for a worker
+        self.threads = []
+        self.in_flight = 0
+        self.paused = False
+        self.last_poll = {}  # account -> time of last successful fetch
+        self.last_error = None
+        self.processed_count = 0
+    
+    @property
+    def running(self):
+        return any(thread.is_alive() for thread in self.threads) and not self.stop_event.is_set()
     
     def start_processing(self):
-        self.running = True
-        thread = threading.Thread(target=self._process_loop)
-        thread.daemon = True
-        thread.start()
+        """Start the fetch loop and workers; does nothing if already running
+        
+        Returns "started", "already running", or "stopping" when a previous
+        run is still finishing its in-flight emails (start again shortly).
+        """
+        with self.lock:
+            if any(thread.is_alive() for thread in self.threads):
+                return "stopping" if self.stop_event.is_set() else "already running"
+            
+            self.stop_event.clear()
+            self.threads = [threading.Thread(target=self._fetch_loop, name="email-fetch")]
+            self.threads += [
+                threading.Thread(target=self._worker_loop, name=f"email-worker-{i}")
+                for i in range(self.WORKERS)
+            ]
+            for thread in self.threads:
+                thread.daemon = True
+                thread.start()
+        
         print("Email processing started...")
+        return "started"
     
     def stop_processing(self):
-        self.running = False
+        """Stop fetching immediately; workers finish the email they are on"""
+        self.stop_event.set()
         print("Email processing stopped...")
     
-    def _process_loop(self):
-        while self.running:
+    def get_status(self):
+        with self.lock:
+            in_flight = self.in_flight
+            last_poll = dict(self.last_poll)
+        return {
+            "running": self.running,
+            "paused": self.paused,
+            "in_flight": in_flight,
+            "backlog": self.backlog.qsize(),
+            "processed": self.processed_count,
+            "last_poll": {
+                account: datetime.fromtimestamp(polled).isoformat()
+                for account, polled in last_poll.items()
+            },
+            "last_error": self.last_error
+        }
+    
+    def _wait_for_capacity(self):
+        """Hold off fetching while workers are behind (backpressure)"""
+        while self.backlog.qsize() >= self.MAX_BACKLOG and not self.stop_event.is_set():
+            if not self.paused:
+                print(f"Backlog at {self.backlog.qsize()} emails, pausing fetch")
+            self.paused = True
+            self.stop_event.wait(1)
+        self.paused = False
+    
+    def _fetch_loop(self):
+        while not self.stop_event.is_set():
             try:
+                # Apply the processed_emails retention policy about once an hour
+                if time.time() - self.last_prune >= 3600:
+                    self.db.prune_processed_emails()
+                    self.last_prune = time.time()
+                
                 # Check all connected accounts
-                for email in self.gmail_client.services.keys():
-                    new_emails = self.gmail_client.get_new_emails(email)
+                for email in list(self.gmail_client.services.keys()):
+                    self._wait_for_capacity()
+                    if self.stop_event.is_set():
+                        break
                     
-                    for email_data in new_emails:
-                        self.process_email(email_data)
+                    new_emails = self.gmail_client.get_new_emails(email)
+                    with self.lock:
+                        self.last_poll[email] = time.time()
+
+                    # One email, and at most one reply, per thread per cycle
+                    for email_data in self.gmail_client.coalesce_threads(new_emails):
+                        self.backlog.put(email_data)
                 
-                time.sleep(30)  # Check every 30 seconds
+                self.stop_event.wait(self.POLL_INTERVAL)
             except Exception as e:
                 print(f"Error in processing loop: {e}")
-                time.sleep(60)  # Wait longer on error
+                self.last_error = str(e)
+                self.stop_event.wait(self.ERROR_BACKOFF)  # Wait longer on error
+        
+        # Emails fetched while stopping can be queued after the workers
+        # released the backlog and exited, so release whatever is left here too
+        self._release_backlog()
+    
+    def _worker_loop(self):
+        while not self.stop_event.is_set():
+            try:
+                email_data = self.backlog.get(timeout=1)
+            except queue.Empty:
+                continue
+            
+            with self.lock:
+                self.in_flight += 1
+            try:
+                self.process_email(email_data)
+                with self.lock:
+                    self.processed_count += 1
+            except Exception as e:
+                print(f"Error processing email {email_data['id']}: {e}")
+                self.last_error = str(e)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+        
+        self._release_backlog()
+    
+    def _release_backlog(self):
+        """Un-mark queued emails as processed so the next run fetches them again"""
+        message_ids = []
+        while True:
+            try:
+                email_data = self.backlog.get_nowait()
+            except queue.Empty:
+                break
+            message_ids += email_data.get('message_ids', [email_data['id']])
+        
+        if message_ids:
+            self.db.release_processed_emails(message_ids)
+            print(f"Released {len(message_ids)} unprocessed emails for the next run")
     
     def process_email(self, email_data):
         print(f"Processing email: {email_data['subject']}")
+        if len(email_data.get('message_ids', [])) > 1:
+            print(f"DEBUG - Coalesced {len(email_data['message_ids'])} messages from thread {email_data['thread_id']}")
         print(f"DEBUG - Email body received:\n{email_data['body']}")
         
+        # Reuse the outcome of a near-identical recent email if there is one
+        signature = self.duplicate_index.signature(email_data['subject'], email_data['body'])
+        previous = self.duplicate_index.find(signature)
+        llm_calls_saved = 0
+        embedding_calls_saved = 0
+        
         # Categorize email
-        category = self.ai_agent.categorize_email(
-            email_data['subject'], 
-            email_data['body']
-        )
+        if previous:
+            category = previous['category']
+            llm_calls_saved += 1
+            print(f"DEBUG - Near-duplicate of {previous['email_id']} "
+                  f"(similarity {previous['similarity']:.2f}), reusing its outcome")
+        else:
+            category = self.ai_agent.categorize_email(
+                email_data['subject'], 
+                email_data['body']
+            )
         
         print(f"Category: {category}")
+        outcome = {'category': category}
         
         # Process based on category
         response = None
         if category == 'QUESTION':
             print("DEBUG - Processing as QUESTION with RAG")
+            relevant_docs = previous.get('docs') if previous else None
+            if relevant_docs is None:
+                relevant_docs = self.ai_agent.retrieve_context(
+                    f"{email_data['subject']} {email_data['body']}".strip()
+                )
+            else:
+                embedding_calls_saved += 1
+            outcome['docs'] = relevant_docs
             response = self.ai_agent.process_question(
                 email_data['subject'],
                 email_data['body'],
                 email_data['sender'],
                 email_data['id'],
-                email_data['account']
+                email_data['account'],
+                relevant_docs=relevant_docs
             )
         elif category == 'REFUND':
             print("DEBUG - Processing as REFUND")
@@ -68,14 +211,32 @@ class EmailProcessor:
             )
         else:  # OTHER
             print("DEBUG - Processing as OTHER (no auto-reply)")
+            importance = previous.get('importance') if previous else None
+            if importance is None:
+                importance = self.ai_agent.assess_importance(
+                    email_data['subject'],
+                    email_data['body']
+                )
+            else:
+                llm_calls_saved += 1
+            outcome['importance'] = importance
             self.ai_agent.process_other(
                 email_data['subject'],
                 email_data['body'],
                 email_data['sender'],
                 email_data['id'],
-                email_data['account']
+                email_data['account'],
+                importance=importance
             )
         
+        if previous:
+            self.duplicate_index.record_savings(llm_calls_saved, embedding_calls_saved)
+            stats = self.duplicate_index.get_stats()
+            print(f"Near-duplicate savings so far: {stats['llm_calls_saved']} LLM calls, "
+                  f"{stats['embedding_calls_saved']} embedding calls")
+        else:
+            self.duplicate_index.add(email_data['id'], signature, outcome)
+        
         # Send response if generated
         if response:
             print(f"DEBUG - Generated response:\n{response[:200]}...")
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+"""
+Shared Embedding Service
+One process owns the embedding model and the ChromaDB client and serves
+every AIAgent (Flask app, workers, knowledge_manager.py) over a Unix socket.
+Set EMBEDDING_SERVICE_SOCKET to make AIAgent use it instead of loading its
+own copies.
+"""
+
+import os
+import json
+import queue
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+from typing import List, Dict, Any
+
+import numpy as np
+
+DEFAULT_SOCKET_PATH = "/tmp/support-agent-embeddings.sock"
+
+# Collection methods clients may call, with the keyword arguments they accept
+COLLECTION_OPS = {
+    "count": (),
+    "get": ("ids", "where", "include", "limit", "offset"),
+    "query": ("query_embeddings", "n_results", "where", "include"),
+    "add": ("documents", "embeddings", "ids", "metadatas"),
+    "upsert": ("documents", "embeddings", "ids", "metadatas"),
+    "delete": ("ids", "where"),
+}
+
+
+def _json_default(value):
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    raise TypeError(f"Cannot serialize {type(value).__name__}")
+
+
+def send_message(sock: socket.socket, payload: Dict[str, Any]):
+    data = json.dumps(payload, default=_json_default).encode('utf-8')
+    sock.sendall(struct.pack("!I", len(data)) + data)
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1 << 20))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def recv_message(sock: socket.socket) -> Dict[str, Any]:
+    (size,) = struct.unpack("!I", _recv_exact(sock, 4))
+    return json.loads(_recv_exact(sock, size))
+
+
+class MicroBatcher:
+    """Coalesces encode requests from concurrent clients into model batches
+
+    The first pending request waits at most max_wait seconds for others to
+    join; then everything queued (up to max_batch texts, or one larger
+    request) is encoded in model batches of max_batch texts.
+    """
+
+    def __init__(self, model, max_batch: int = 256, max_wait: float = 0.005):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def encode(self, texts: List[str]) -> List[List[float]]:
+        done = threading.Event()
+        slot = {"texts": texts, "done": done}
+        self.requests.put(slot)
+        done.wait()
+        if "error" in slot:
+            raise slot["error"]
+        return slot["result"]
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0]["texts"])
+            try:
+                while size < self.max_batch:
+                    slot = self.requests.get(timeout=self.max_wait)
+                    batch.append(slot)
+                    size += len(slot["texts"])
+            except queue.Empty:
+                pass
+
+            texts = [text for slot in batch for text in slot["texts"]]
+            try:
+                # Fixed batch size: one large request must not become one huge padded batch
+                embeddings = self.model.encode(texts, batch_size=self.max_batch).tolist()
+            except Exception as e:
+                for slot in batch:
+                    slot["error"] = e
+                    slot["done"].set()
+                continue
+
+            start = 0
+            for slot in batch:
+                end = start + len(slot["texts"])
+                slot["result"] = embeddings[start:end]
+                start = end
+                slot["done"].set()
+
+
+class EmbeddingServer(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_path: str, chroma_path: str = "./chroma_db"):
+        import chromadb
+        from chromadb.config import Settings
+        from sentence_transformers import SentenceTransformer
+
+        self.batcher = MicroBatcher(SentenceTransformer('all-MiniLM-L6-v2'))
+        self.chroma_client = chromadb.PersistentClient(
+            path=chroma_path,
+            settings=Settings(allow_reset=True, anonymized_telemetry=False)
+        )
+        self.collections = {}
+        self.collections_lock = threading.Lock()
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, EmbeddingRequestHandler)
+
+    def collection(self, name: str, metadata: Dict[str, Any] = None):
+        with self.collections_lock:
+            if name not in self.collections:
+                self.collections[name] = self.chroma_client.get_or_create_collection(
+                    name=name,
+                    metadata=metadata
+                )
+            return self.collections[name]
+
+    def dispatch(self, request: Dict[str, Any]):
+        op = request.get("op")
+        if op == "encode":
+            return self.batcher.encode(request["texts"])
+        if op in COLLECTION_OPS:
+            collection = self.collection(request["collection"], request.get("metadata"))
+            kwargs = {
+                key: value for key, value in request.get("kwargs", {}).items()
+                if key in COLLECTION_OPS[op]
+            }
+            return getattr(collection, op)(**kwargs)
+        raise ValueError(f"Unknown operation: {op}")
+
+
+class EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = recv_message(self.request)
+            except (ConnectionError, struct.error):
+                return
+            try:
+                response = {"ok": True, "result": self.server.dispatch(request)}
+            except Exception as e:
+                response = {"ok": False, "error": f"{type(e).__name__}: {e}"}
+            send_message(self.request, response)
+
+
+class EmbeddingServiceClient:
+    """Connection to the embedding service, one socket per calling thread"""
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH):
+        self.socket_path = socket_path
+        self.local = threading.local()
+
+    def _socket(self) -> socket.socket:
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.socket_path)
+            self.local.sock = sock
+        return sock
+
+    def call(self, op: str, **request):
+        try:
+            sock = self._socket()
+            send_message(sock, {"op": op, **request})
+            response = recv_message(sock)
+        except (OSError, ConnectionError):
+            # Drop the broken connection so the next call reconnects
+            self.local.sock = None
+            raise
+        if not response["ok"]:
+            raise RuntimeError(f"Embedding service error: {response['error']}")
+        return response["result"]
+
+
+class RemoteEmbeddingModel:
+    """Drop-in for SentenceTransformer.encode backed by the embedding service"""
+
+    def __init__(self, client: EmbeddingServiceClient):
+        self.client = client
+
+    def encode(self, sentences, batch_size: int = None, **kwargs):
+        if isinstance(sentences, str):
+            return np.asarray(self.client.call("encode", texts=[sentences])[0], dtype=np.float32)
+        return np.asarray(self.client.call("encode", texts=list(sentences)), dtype=np.float32)
+
+
+class RemoteCollection:
+    """Drop-in for the ChromaDB collection methods AIAgent and its tools use"""
+
+    def __init__(self, client: EmbeddingServiceClient, name: str, metadata: Dict[str, Any] = None):
+        self.client = client
+        self.name = name
+        self.metadata = metadata
+
+    def _call(self, op: str, **kwargs):
+        return self.client.call(op, collection=self.name, metadata=self.metadata, kwargs=kwargs)
+
+    def count(self):
+        return self._call("count")
+
+    def get(self, **kwargs):
+        return self._call("get", **kwargs)
+
+    def query(self, **kwargs):
+        return self._call("query", **kwargs)
+
+    def add(self, **kwargs):
+        return self._call("add", **kwargs)
+
+    def upsert(self, **kwargs):
+        return self._call("upsert", **kwargs)
+
+    def delete(self, **kwargs):
+        return self._call("delete", **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve embeddings and knowledge base search over a Unix socket")
+    parser.add_argument("--socket", default=os.getenv("EMBEDDING_SERVICE_SOCKET", DEFAULT_SOCKET_PATH))
+    parser.add_argument("--chroma-path", default="./chroma_db")
+    args = parser.parse_args()
+
+    server = EmbeddingServer(args.socket, args.chroma_path)
+    print(f"Embedding service listening on {args.socket}")
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
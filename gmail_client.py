@@ -1,10 +1,46 @@
 import base64
 import json
 import os
+import threading
+import time
+import psycopg2.extras
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import Flow
-from googleapiclient.discovery import build
+from googleapiclient import discovery_cache
+from googleapiclient.discovery import build, build_from_document
+from database import connect
+from mime_extractor import extract_text, MAX_BODY_CHARS
+
+class GmailServiceFactory:
+    """Builds Gmail API services from one shared discovery document
+    
+    build('gmail', 'v1') reads and parses the discovery document for every
+    account. The bundled static document is parsed once here and every
+    service is built from it.
+    """
+    
+    _document = None
+    _lock = threading.Lock()
+    
+    @classmethod
+    def discovery_document(cls):
+        with cls._lock:
+            if cls._document is None:
+                document = discovery_cache.get_static_doc('gmail', 'v1')
+                if document is not None:
+                    cls._document = json.loads(document)
+            return cls._document
+    
+    @classmethod
+    def build(cls, credentials):
+        document = cls.discovery_document()
+        if document is None:
+            # Library without bundled discovery documents
+            return build('gmail', 'v1', credentials=credentials)
+        return build_from_document(document, credentials=credentials)
 
 class GmailClient:
     SCOPES = [
@@ -13,9 +49,20 @@ class GmailClient:
     "https://www.googleapis.com/auth/gmail.modify"
     ]
 
+    REFRESH_MARGIN = timedelta(minutes=5)  # refresh tokens this long before they expire
+    REFRESH_INTERVAL = 60  # seconds between expiry checks
+
     def __init__(self, db):
         self.db = db
         self.services = {}  # email -> service mapping
+        self.thread_services = threading.local()  # per-thread services, see service()
+        self.credentials = {}  # email -> Credentials, kept fresh by the refresher
+        self.refresh_wakeup = threading.Event()
+        self.token_conn = None  # the refresher's own connection, db.conn is shared
+        
+        thread = threading.Thread(target=self._refresh_loop)
+        thread.daemon = True
+        thread.start()
     
     def get_auth_url(self):
         flow = Flow.from_client_secrets_file(
@@ -41,7 +88,7 @@ class GmailClient:
         flow.fetch_token(code=code)
         
         credentials = flow.credentials
-        service = build('gmail', 'v1', credentials=credentials)
+        service = GmailServiceFactory.build(credentials)
         
         # Get user email
         profile = service.users().getProfile(userId='me').execute()
@@ -50,37 +97,129 @@ class GmailClient:
         # Store credentials in database
         cursor = self.db.conn.cursor()
         cursor.execute("""
-            INSERT INTO gmail_accounts (email, access_token, refresh_token) 
-            VALUES (%s, %s, %s) 
+            INSERT INTO gmail_accounts (email, access_token, refresh_token, token_expiry) 
+            VALUES (%s, %s, %s, %s) 
             ON CONFLICT (email) DO UPDATE SET 
                 access_token = EXCLUDED.access_token,
-                refresh_token = EXCLUDED.refresh_token
-        """, (email, credentials.token, credentials.refresh_token))
+                refresh_token = EXCLUDED.refresh_token,
+                token_expiry = EXCLUDED.token_expiry
+        """, (email, credentials.token, credentials.refresh_token, credentials.expiry))
         self.db.conn.commit()
         cursor.close()
         
+        self.credentials[email] = credentials
         self.services[email] = service
         return email
     
     def load_accounts(self):
         cursor = self.db.conn.cursor()
-        cursor.execute("SELECT email, access_token, refresh_token FROM gmail_accounts")
+        cursor.execute("SELECT email, access_token, refresh_token, token_expiry FROM gmail_accounts")
         accounts = cursor.fetchall()
         cursor.close()
         
-        for email, access_token, refresh_token in accounts:
+        for email, access_token, refresh_token, token_expiry in accounts:
             try:
                 credentials = Credentials(
                     token=access_token,
                     refresh_token=refresh_token,
                     token_uri='https://oauth2.googleapis.com/token',
                     client_id=os.getenv('GOOGLE_CLIENT_ID'),
-                    client_secret=os.getenv('GOOGLE_CLIENT_SECRET')
+                    client_secret=os.getenv('GOOGLE_CLIENT_SECRET'),
+                    expiry=token_expiry
                 )
-                service = build('gmail', 'v1', credentials=credentials)
+                service = GmailServiceFactory.build(credentials)
+                self.credentials[email] = credentials
                 self.services[email] = service
             except Exception as e:
                 print(f"Failed to load account {email}: {e}")
+        
+        # Refresh expiring tokens now rather than on the first poll
+        self.refresh_wakeup.set()
+    
+    def needs_refresh(self, credentials):
+        # Tokens stored without an expiry are refreshed once to learn it
+        if credentials.expiry is None:
+            return True
+        return credentials.expiry - datetime.utcnow() <= self.REFRESH_MARGIN
+    
+    def refresh_credentials(self, email):
+        """Refresh an account's access token in memory
+        
+        The new token is persisted by save_tokens.
+        """
+        credentials = self.credentials.get(email)
+        if credentials is None or not credentials.refresh_token:
+            return False
+        
+        try:
+            credentials.refresh(Request())
+        except Exception as e:
+            print(f"Failed to refresh token for {email}: {e}")
+            return False
+        return True
+    
+    def save_tokens(self, emails):
+        """Persist the current access tokens of the given accounts in one UPDATE
+        
+        Runs on a dedicated connection so token writes never commit or roll
+        back a transaction of the fetch and worker threads on db.conn.
+        """
+        rows = [
+            (email, self.credentials[email].token, self.credentials[email].expiry)
+            for email in emails if email in self.credentials
+        ]
+        if not rows:
+            return
+        
+        if self.token_conn is None or self.token_conn.closed:
+            self.token_conn = connect()
+        
+        cursor = self.token_conn.cursor()
+        try:
+            psycopg2.extras.execute_values(
+                cursor,
+                """
+                UPDATE gmail_accounts
+                SET access_token = refreshed.access_token, token_expiry = refreshed.token_expiry
+                FROM (VALUES %s) AS refreshed (email, access_token, token_expiry)
+                WHERE gmail_accounts.email = refreshed.email
+                """,
+                rows,
+                template="(%s, %s, %s::timestamp)",
+                page_size=len(rows)
+            )
+            self.token_conn.commit()
+        except Exception:
+            self.token_conn.rollback()
+            raise
+        finally:
+            cursor.close()
+    
+    def _refresh_loop(self):
+        """Refresh tokens in the background before they expire
+        
+        Tokens are refreshed in parallel; all of them are then saved from
+        this thread in a single batch.
+        """
+        unsaved = set()
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            while True:
+                due = [
+                    email for email, credentials in list(self.credentials.items())
+                    if self.needs_refresh(credentials)
+                ]
+                refreshed = pool.map(self.refresh_credentials, due)
+                unsaved.update(email for email, ok in zip(due, refreshed) if ok)
+                
+                try:
+                    self.save_tokens(unsaved)
+                    unsaved.clear()
+                except Exception as e:
+                    # Tokens stay valid in memory; saving is retried next round
+                    print(f"Failed to save refreshed tokens: {e}")
+                
+                self.refresh_wakeup.wait(self.REFRESH_INTERVAL)
+                self.refresh_wakeup.clear()
     
     def disconnect_account(self, email):
         cursor = self.db.conn.cursor()
@@ -90,15 +229,36 @@ class GmailClient:
         
         if email in self.services:
             del self.services[email]
+        self.credentials.pop(email, None)
+    
+    def service(self, email):
+        """The calling thread's Gmail service for an account
+        
+        Services sit on httplib2.Http, which is not thread-safe, so the fetch
+        loop and each worker get their own, built from the account's credentials.
+        """
+        credentials = self.credentials.get(email)
+        if credentials is None:
+            return None
+        
+        services = self.thread_services.__dict__.setdefault('services', {})
+        cached = services.get(email)
+        # Rebuilt when the account was reconnected with new credentials
+        if cached is None or cached[0] is not credentials:
+            cached = (credentials, GmailServiceFactory.build(credentials))
+            services[email] = cached
+        return cached[1]
     
     def get_new_emails(self, email):
         if email not in self.services:
             return []
         
-        service = self.services[email]
+        service = self.service(email)
         
         # Get list of messages
-        results = service.users().messages().list(userId='me', q='is:unread').execute()
+        # Stay inside the processed_emails retention window so pruned history is never re-fetched
+        query = f'is:unread newer_than:{self.db.retention_days}d'
+        results = service.users().messages().list(userId='me', q=query).execute()
         messages = results.get('messages', [])
         
         new_emails = []
@@ -125,6 +285,8 @@ class GmailClient:
             
             new_emails.append({
                 'id': msg_id,
+                'thread_id': msg.get('threadId', msg_id),
+                'timestamp': int(msg.get('internalDate', 0)) / 1000,
                 'subject': subject,
                 'sender': sender,
                 'body': body,
@@ -141,25 +303,42 @@ class GmailClient:
         cursor.close()
         return new_emails
     
+    def coalesce_threads(self, emails):
+        """Merge new messages of the same thread into one email
+        
+        Follow-ups a customer sent since the last poll are combined so the
+        thread is categorized and answered once per cycle. Returns the merged
+        emails in arrival order; each carries the ids of the messages it covers.
+        """
+        threads = {}
+        for email_data in sorted(emails, key=lambda e: e['timestamp']):
+            threads.setdefault(email_data['thread_id'], []).append(email_data)
+        
+        coalesced = []
+        for group in threads.values():
+            latest = group[-1]
+            if len(group) == 1:
+                body = latest['body']
+            else:
+                body = "\n\n---\n\n".join(m['body'] for m in group if m['body'])
+            coalesced.append({
+                **latest,
+                'subject': group[0]['subject'],
+                'body': body,
+                'message_ids': [m['id'] for m in group]
+            })
+        
+        coalesced.sort(key=lambda e: e['timestamp'])
+        return coalesced
+    
     def extract_body(self, payload):
-        body = ""
-        if 'parts' in payload:
-            for part in payload['parts']:
-                if part['mimeType'] == 'text/plain':
-                    data = part['body']['data']
-                    body = base64.urlsafe_b64decode(data).decode('utf-8')
-                    break
-        else:
-            if payload['mimeType'] == 'text/plain':
-                data = payload['body']['data']
-                body = base64.urlsafe_b64decode(data).decode('utf-8')
-        return body
+        return extract_text(payload, MAX_BODY_CHARS)
     
     def send_reply(self, to_email, subject, body, account_email):
         if account_email not in self.services:
             return False
         
-        service = self.services[account_email]
+        service = self.service(account_email)
         
         message = f"""To: {to_email}
 Subject: Re: {subject}
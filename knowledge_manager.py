@@ -5,12 +5,134 @@ Allows you to manage the ChromaDB vector knowledge base
 """
 
 import os
+import sys
+import json
+import time
+import random
+import argparse
+import multiprocessing
+import numpy as np
+import chromadb
+from chromadb.config import Settings
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from typing import Iterator, List, Dict, Any
 from dotenv import load_dotenv
 from database import Database  
-from ai_agent import AIAgent
+from ai_agent import AIAgent, SEED_KNOWLEDGE_DOCS, save_hnsw_config
+from knowledge_sync import KnowledgeSync
+from embedding_service import RemoteEmbeddingModel
 
 load_dotenv()
 
+IMPORT_EXTENSIONS = ('.md', '.markdown', '.txt', '.jsonl')
+
+# Queries with the knowledge base category that should answer them
+LABELLED_QUERIES = [
+    ("How long does shipping take?", "shipping"),
+    ("How much is express delivery?", "shipping"),
+    ("Where can I track my package?", "shipping"),
+    ("Can I return an item?", "returns"),
+    ("How do I get a return label?", "returns"),
+    ("Is my blender still under warranty?", "warranty"),
+    ("What payment methods do you accept?", "payment"),
+    ("My card was declined, what should I do?", "payment"),
+    ("How do I contact support?", "support"),
+    ("What are your customer service hours?", "support"),
+    ("What kinds of products do you sell?", "products"),
+    ("Do I need an account to track orders?", "account"),
+]
+
+# HNSW parameter sets compared by the retrieval benchmark
+HNSW_CANDIDATES = [
+    {"hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 10},
+    {"hnsw:M": 16, "hnsw:construction_ef": 100, "hnsw:search_ef": 50},
+    {"hnsw:M": 16, "hnsw:construction_ef": 200, "hnsw:search_ef": 100},
+    {"hnsw:M": 32, "hnsw:construction_ef": 200, "hnsw:search_ef": 100},
+]
+
+def synthetic_corpus(base_docs: List[Dict[str, Any]], size: int, seed: int = 7) -> List[Dict[str, Any]]:
+    """Grow base_docs to size by mixing words of a document with corpus-wide noise"""
+    rng = random.Random(seed)
+    vocabulary = [word for doc in base_docs for word in doc["content"].split()]
+    corpus = list(base_docs[:size])
+    while len(corpus) < size:
+        doc = rng.choice(base_docs)
+        words = doc["content"].split()
+        kept = rng.sample(words, max(1, int(len(words) * 0.6)))
+        noise = rng.sample(vocabulary, min(10, len(vocabulary)))
+        mixed = kept + noise
+        rng.shuffle(mixed)
+        corpus.append({"content": " ".join(mixed), "category": doc["category"]})
+    return corpus
+
+def percentile(values: List[float], pct: float) -> float:
+    return float(np.percentile(values, pct)) if values else 0.0
+
+# Embedding model loaded once per import worker process
+_worker_model = None
+
+def _init_encoder(model_name: str):
+    global _worker_model
+    from sentence_transformers import SentenceTransformer
+    _worker_model = SentenceTransformer(model_name)
+
+def _encode_batch(texts: List[str]) -> List[List[float]]:
+    return _worker_model.encode(texts, batch_size=len(texts)).tolist()
+
+def chunk_text(text: str, chunk_size: int = 200, overlap: int = 40) -> List[str]:
+    """Split text into overlapping chunks of roughly chunk_size words"""
+    words = text.split()
+    if len(words) <= chunk_size:
+        return [" ".join(words)] if words else []
+    
+    step = max(chunk_size - overlap, 1)
+    chunks = []
+    for start in range(0, len(words), step):
+        chunks.append(" ".join(words[start:start + chunk_size]))
+        if start + chunk_size >= len(words):
+            break
+    return chunks
+
+def iter_import_documents(directory: str, default_category: str = None) -> Iterator[Dict[str, Any]]:
+    """Stream documents from Markdown, text and JSONL files under directory
+    
+    Markdown/text files become one document each, categorized by their parent
+    folder. JSONL lines need a "content" (or "text") field and may carry
+    category, topic and priority.
+    """
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            if not name.lower().endswith(IMPORT_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            folder = os.path.relpath(root, directory)
+            category = default_category or (folder.split(os.sep)[0] if folder != '.' else 'general')
+            
+            if name.lower().endswith('.jsonl'):
+                with open(path, encoding='utf-8') as f:
+                    for line_no, line in enumerate(f, 1):
+                        if not line.strip():
+                            continue
+                        record = json.loads(line)
+                        yield {
+                            "content": record.get("content") or record.get("text", ""),
+                            "category": record.get("category", category),
+                            "topic": record.get("topic", ""),
+                            "priority": record.get("priority", "medium"),
+                            "source_path": f"{path}:{line_no}",
+                            "file": path
+                        }
+            else:
+                with open(path, encoding='utf-8') as f:
+                    yield {
+                        "content": f.read(),
+                        "category": category,
+                        "topic": os.path.splitext(name)[0],
+                        "priority": "medium",
+                        "source_path": path,
+                        "file": path
+                    }
+
 class KnowledgeManager:
     def __init__(self):
         self.db = Database()
@@ -63,6 +185,266 @@ class KnowledgeManager:
         self.ai_agent.add_knowledge_document(content, category, metadata)
         print(f"Added document to category: {category}")
     
+    def bulk_import(self, directory: str, category: str = None, chunk_size: int = 200,
+                    overlap: int = 40, batch_size: int = 256, workers: int = None):
+        """Import a directory of articles into the knowledge base
+        
+        Articles are chunked, chunks already stored are skipped, and the rest
+        are encoded in batches across a process pool (or sent to the shared
+        embedding service from a thread pool) and written with one add() call
+        per batch. Each file's chunks are recorded in the manifest
+        as their own source, so chunks of articles that were edited or removed
+        since the last import of the directory are deleted afterwards.
+        """
+        workers = workers or min(4, os.cpu_count() or 1)
+        collection = self.ai_agent.knowledge_collection
+        sync = self.ai_agent.knowledge_sync
+        manifest = sync.load_manifest()
+        prefix = f"import:{os.path.abspath(directory)}{os.sep}"
+        previous = {source: manifest.pop(source) for source in list(manifest) if source.startswith(prefix)}
+        current = {}  # manifest source -> {chunk id: hash} of this import
+        current_categories = {}  # manifest source -> categories of its chunks
+        seen = {}  # chunk id -> hash, for chunks shared by several articles
+        stats = {"chunks": 0, "added": 0, "skipped": 0, "deleted": 0}
+        started = time.time()
+        
+        def batches():
+            batch = []
+            for doc in iter_import_documents(directory, category):
+                chunks = chunk_text(doc["content"], chunk_size, overlap)
+                for index, chunk in enumerate(chunks):
+                    doc_id = KnowledgeSync.document_id(doc["category"], chunk)
+                    stats["chunks"] += 1
+                    source = f"import:{os.path.abspath(doc['file'])}"
+                    current_categories.setdefault(source, set()).add(doc["category"])
+                    if doc_id in seen:
+                        current.setdefault(source, {})[doc_id] = seen[doc_id]
+                        stats["skipped"] += 1
+                        continue
+                    metadata = {
+                        "topic": doc["topic"],
+                        "priority": doc["priority"],
+                        "source_path": doc["source_path"],
+                        "chunk": index,
+                        "chunk_count": len(chunks)
+                    }
+                    seen[doc_id] = KnowledgeSync.content_hash(chunk, doc["category"], metadata)
+                    current.setdefault(source, {})[doc_id] = seen[doc_id]
+                    batch.append({
+                        "id": doc_id,
+                        "content": chunk,
+                        "category": doc["category"],
+                        "metadata": metadata,
+                        "hash": seen[doc_id]
+                    })
+                    if len(batch) >= batch_size:
+                        yield batch
+                        batch = []
+            if batch:
+                yield batch
+        
+        def write(batch, embeddings):
+            collection.add(
+                documents=[doc["content"] for doc in batch],
+                embeddings=embeddings,
+                ids=[doc["id"] for doc in batch],
+                metadatas=[
+                    {
+                        "category": doc["category"],
+                        **doc["metadata"],
+                        "content_hash": doc["hash"],
+                        "source": "import"
+                    }
+                    for doc in batch
+                ]
+            )
+            stats["added"] += len(batch)
+            elapsed = time.time() - started
+            print(f"Imported {stats['added']} chunks ({stats['skipped']} skipped), "
+                  f"{stats['added'] / max(elapsed, 1e-9):.1f} docs/sec")
+        
+        def new_only(batch):
+            stored = sync.existing_hashes([doc["id"] for doc in batch])
+            fresh = [doc for doc in batch if doc["id"] not in stored]
+            stats["skipped"] += len(batch) - len(fresh)
+            return fresh
+        
+        if workers <= 1:
+            for batch in batches():
+                batch = new_only(batch)
+                if batch:
+                    write(batch, self.ai_agent.embedding_model.encode(
+                        [doc["content"] for doc in batch], batch_size=batch_size
+                    ).tolist())
+        else:
+            model = self.ai_agent.embedding_model
+            if isinstance(model, RemoteEmbeddingModel):
+                # The embedding service already holds the model; threads only keep requests in flight
+                pool = ThreadPoolExecutor(max_workers=workers)
+                
+                def encode(texts):
+                    return model.encode(texts).tolist()
+            else:
+                pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_encoder,
+                    initargs=('all-MiniLM-L6-v2',)
+                )
+                encode = _encode_batch
+            pending = {}
+            with pool:
+                for batch in batches():
+                    batch = new_only(batch)
+                    if not batch:
+                        continue
+                    # Bound in-flight batches so large imports stream instead of queueing everything
+                    while len(pending) >= workers * 2:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            write(pending.pop(future), future.result())
+                    future = pool.submit(encode, [doc["content"] for doc in batch])
+                    pending[future] = batch
+                for future in list(pending):
+                    write(pending.pop(future), future.result())
+        
+        # Delete chunks of edited or removed articles unless another import still uses them
+        manifest.update(current)
+        still_imported = {
+            doc_id for source, hashes in manifest.items()
+            if source.startswith("import:") for doc_id in hashes
+        }
+        removed = sorted({
+            doc_id for hashes in previous.values() for doc_id in hashes
+        } - still_imported)
+        for start in range(0, len(removed), sync.batch_size):
+            collection.delete(ids=removed[start:start + sync.batch_size])
+        stats["deleted"] = len(removed)
+        
+        for source in previous:
+            KnowledgeSync.record_categories(manifest, source, None)
+        for source, categories in current_categories.items():
+            KnowledgeSync.record_categories(manifest, source, categories)
+        sync.save_manifest(manifest)
+        self.ai_agent.refresh_categories()
+        elapsed = time.time() - started
+        print(f"\nImport finished: {stats['added']} chunks added, {stats['skipped']} skipped, "
+              f"{stats['deleted']} outdated deleted out of {stats['chunks']} in {elapsed:.1f}s "
+              f"({stats['added'] / max(elapsed, 1e-9):.1f} docs/sec)")
+        return stats
+    
+    def benchmark_retrieval(self, sizes=(1000, 10000), configs=None, k: int = 3,
+                            source_dir: str = None, repeats: int = 5,
+                            target_recall: float = 0.95, persist: bool = False):
+        """Measure recall@k and query latency of HNSW settings against exact search
+        
+        Corpora of each size are built from the seed documents (plus articles
+        from source_dir) and searched with LABELLED_QUERIES in throwaway
+        in-memory collections. The fastest config reaching target_recall on
+        the largest corpus is reported and, with persist, saved for new
+        knowledge base collections.
+        """
+        configs = configs or HNSW_CANDIDATES
+        base_docs = [{"content": d["content"], "category": d["category"]} for d in SEED_KNOWLEDGE_DOCS]
+        if source_dir:
+            for doc in iter_import_documents(source_dir):
+                for chunk in chunk_text(doc["content"]):
+                    base_docs.append({"content": chunk, "category": doc["category"]})
+        
+        corpus = synthetic_corpus(base_docs, max(sizes))
+        print(f"Encoding benchmark corpus of {len(corpus)} documents...")
+        model = self.ai_agent.embedding_model
+        embeddings = np.asarray(model.encode([d["content"] for d in corpus], batch_size=256), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        queries = np.asarray(model.encode([q for q, _ in LABELLED_QUERIES]), dtype=np.float32)
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        
+        client = chromadb.EphemeralClient(settings=Settings(anonymized_telemetry=False))
+        results = []
+        
+        for size in sorted(sizes):
+            vectors = embeddings[:size]
+            
+            # Exact search is the ground truth and the brute-force backend
+            latencies = []
+            exact = []
+            for _ in range(repeats):
+                exact = []
+                for query in queries:
+                    started = time.perf_counter()
+                    scores = vectors @ query
+                    top = np.argpartition(-scores, min(k, size - 1))[:k]
+                    exact.append(top[np.argsort(-scores[top])].tolist())
+                    latencies.append((time.perf_counter() - started) * 1000)
+            results.append(self._benchmark_row(size, "exact", {}, 1.0, latencies, exact, corpus))
+            
+            for index, config in enumerate(configs):
+                collection = client.create_collection(
+                    name=f"benchmark_{size}_{index}",
+                    metadata={"hnsw:space": "cosine", **config}
+                )
+                started = time.perf_counter()
+                for start in range(0, size, 5000):
+                    end = min(start + 5000, size)
+                    collection.add(
+                        ids=[str(i) for i in range(start, end)],
+                        embeddings=vectors[start:end].tolist()
+                    )
+                build_seconds = time.perf_counter() - started
+                
+                latencies = []
+                found = []
+                for _ in range(repeats):
+                    found = []
+                    for query in queries:
+                        started = time.perf_counter()
+                        response = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+                        latencies.append((time.perf_counter() - started) * 1000)
+                        found.append([int(i) for i in response["ids"][0]])
+                
+                recall = float(np.mean([len(set(exact[i]) & set(ids)) / k for i, ids in enumerate(found)]))
+                row = self._benchmark_row(size, "hnsw", config, recall, latencies, found, corpus)
+                row["build_seconds"] = build_seconds
+                results.append(row)
+                client.delete_collection(f"benchmark_{size}_{index}")
+        
+        print(f"\n{'size':>7} {'backend':<8} {'M':>3} {'c_ef':>5} {'s_ef':>5} "
+              f"{f'recall@{k}':>9} {'top1 cat':>8} {'p50 ms':>7} {'p99 ms':>7}")
+        for row in results:
+            config = row["config"]
+            print(f"{row['size']:>7} {row['backend']:<8} {config.get('hnsw:M', '-'):>3} "
+                  f"{config.get('hnsw:construction_ef', '-'):>5} {config.get('hnsw:search_ef', '-'):>5} "
+                  f"{row['recall']:>9.3f} {row['category_accuracy']:>8.3f} "
+                  f"{row['p50_ms']:>7.2f} {row['p99_ms']:>7.2f}")
+        
+        largest = [r for r in results if r["size"] == max(sizes) and r["backend"] == "hnsw"]
+        eligible = [r for r in largest if r["recall"] >= target_recall] or largest
+        best = min(eligible, key=lambda r: (r["recall"] < target_recall, r["p99_ms"]))
+        print(f"\nChosen HNSW parameters: {best['config']} "
+              f"(recall@{k} {best['recall']:.3f}, p99 {best['p99_ms']:.2f} ms)")
+        
+        if persist:
+            save_hnsw_config(best["config"])
+            print("Saved; they apply when the knowledge base collection is next created.")
+        return results
+    
+    @staticmethod
+    def _benchmark_row(size, backend, config, recall, latencies, top_ids, corpus):
+        labels = [category for _, category in LABELLED_QUERIES]
+        hits = [
+            bool(ids) and corpus[ids[0]]["category"] == label
+            for ids, label in zip(top_ids, labels)
+        ]
+        return {
+            "size": size,
+            "backend": backend,
+            "config": config,
+            "recall": recall,
+            "category_accuracy": float(np.mean(hits)),
+            "p50_ms": percentile(latencies, 50),
+            "p99_ms": percentile(latencies, 99),
+        }
+    
     def view_collection_stats(self):
         """View statistics about the knowledge base"""
         count = self.ai_agent.knowledge_collection.count()
@@ -85,7 +467,7 @@ class KnowledgeManager:
     def interactive_mode(self):
         """Interactive mode for testing and management"""
         print("Knowledge Base Manager - Interactive Mode")
-        print("Commands: search, rag, add, stats, quit")
+        print("Commands: search, rag, add, import, stats, quit")
         
         while True:
             command = input("\n> ").strip().lower()
@@ -103,14 +485,62 @@ class KnowledgeManager:
                 category = input("Enter category: ")
                 topic = input("Enter topic (optional): ")
                 self.add_document(content, category, topic)
+            elif command == 'import':
+                directory = input("Enter directory to import: ")
+                self.bulk_import(directory)
             elif command == 'stats':
                 self.view_collection_stats()
             else:
-                print("Unknown command. Available: search, rag, add, stats, quit")
+                print("Unknown command. Available: search, rag, add, import, stats, quit")
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Manage the ChromaDB vector knowledge base")
+    subparsers = parser.add_subparsers(dest="command")
+    
+    import_parser = subparsers.add_parser("import", help="Bulk import a directory of articles")
+    import_parser.add_argument("directory", help="Directory of .md, .txt and .jsonl files")
+    import_parser.add_argument("--category", help="Category for all documents (default: top-level folder name)")
+    import_parser.add_argument("--chunk-size", type=int, default=200, help="Words per chunk")
+    import_parser.add_argument("--overlap", type=int, default=40, help="Words shared by consecutive chunks")
+    import_parser.add_argument("--batch-size", type=int, default=256, help="Chunks per encode/add batch")
+    import_parser.add_argument("--workers", type=int, default=None, help="Encoder processes (threads when using the embedding service)")
+    
+    bench_parser = subparsers.add_parser("benchmark", help="Measure retrieval recall/latency and tune HNSW")
+    bench_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000], help="Corpus sizes to test")
+    bench_parser.add_argument("--k", type=int, default=3, help="Results per query")
+    bench_parser.add_argument("--source", help="Directory of articles to include in the corpus")
+    bench_parser.add_argument("--repeats", type=int, default=5, help="Times each query is run")
+    bench_parser.add_argument("--target-recall", type=float, default=0.95, help="Minimum recall for the chosen config")
+    bench_parser.add_argument("--persist", action="store_true", help="Save the chosen HNSW parameters")
+    
+    return parser.parse_args(argv)
 
 def main():
+    args = parse_args(sys.argv[1:])
     manager = KnowledgeManager()
     
+    if args.command == "import":
+        manager.bulk_import(
+            args.directory,
+            category=args.category,
+            chunk_size=args.chunk_size,
+            overlap=args.overlap,
+            batch_size=args.batch_size,
+            workers=args.workers
+        )
+        return
+    
+    if args.command == "benchmark":
+        manager.benchmark_retrieval(
+            sizes=args.sizes,
+            k=args.k,
+            source_dir=args.source,
+            repeats=args.repeats,
+            target_recall=args.target_recall,
+            persist=args.persist
+        )
+        return
+    
     # Show initial stats
     manager.view_collection_stats()
     
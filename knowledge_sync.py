@@ -0,0 +1,145 @@
+import hashlib
+import json
+import os
+from typing import List, Dict, Any, Set
+
+
+class KnowledgeSync:
+    """Content-hashed incremental ingestion into the knowledge base collection.
+
+    Every document is stored with a hash of its content and metadata. Syncing
+    a set of documents only embeds the ones whose hash changed, and documents
+    that disappeared from a source since the last sync are deleted. The hashes
+    of each source, and the categories its documents belong to, are recorded
+    in a JSON manifest next to the collection.
+    """
+    
+    CATEGORIES_KEY = "_categories"  # manifest entry: source -> categories of its documents
+
+    def __init__(self, collection, embedding_model, manifest_path: str, batch_size: int = 64):
+        self.collection = collection
+        self.embedding_model = embedding_model
+        self.manifest_path = manifest_path
+        self.batch_size = batch_size
+
+    @staticmethod
+    def content_hash(content: str, category: str, metadata: Dict[str, Any] = None) -> str:
+        payload = json.dumps(
+            {"content": content, "category": category, "metadata": metadata or {}},
+            sort_keys=True
+        )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def document_id(category: str, content: str) -> str:
+        """Stable ID derived from the content, so re-adding a document never duplicates it"""
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        return f"{category}_{digest[:16]}"
+
+    def load_manifest(self) -> Dict[str, Dict[str, str]]:
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f)
+
+    def save_manifest(self, manifest: Dict[str, Dict[str, str]]):
+        os.makedirs(os.path.dirname(self.manifest_path) or ".", exist_ok=True)
+        tmp_path = f"{self.manifest_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    @classmethod
+    def record_categories(cls, manifest: Dict[str, Any], source: str, categories):
+        recorded = manifest.setdefault(cls.CATEGORIES_KEY, {})
+        if categories:
+            recorded[source] = sorted(categories)
+        else:
+            recorded.pop(source, None)
+    
+    def categories(self) -> Set[str]:
+        """Categories of all synced documents, read from the manifest"""
+        recorded = self.load_manifest().get(self.CATEGORIES_KEY, {})
+        return {category for categories in recorded.values() for category in categories}
+    
+    def existing_hashes(self, ids: List[str]) -> Dict[str, str]:
+        """Look up the stored content hash for each of the given IDs"""
+        hashes = {}
+        for start in range(0, len(ids), self.batch_size):
+            result = self.collection.get(ids=ids[start:start + self.batch_size], include=["metadatas"])
+            for doc_id, metadata in zip(result['ids'], result['metadatas']):
+                hashes[doc_id] = (metadata or {}).get("content_hash")
+        return hashes
+
+    def sync(self, docs: List[Dict[str, Any]], source: str, prune: bool = True) -> Dict[str, int]:
+        """Bring the collection in line with docs for the given source
+
+        Each doc is a dict with content, category, optional metadata and
+        optional id. With prune, documents previously synced from this source
+        that are no longer present are deleted.
+        """
+        manifest = self.load_manifest()
+        previous = manifest.get(source, {})
+
+        prepared = {}
+        for doc in docs:
+            doc_id = doc.get("id") or self.document_id(doc["category"], doc["content"])
+            prepared[doc_id] = {
+                **doc,
+                "hash": self.content_hash(doc["content"], doc["category"], doc.get("metadata"))
+            }
+
+        stored = self.existing_hashes(list(prepared))
+        changed = [
+            doc_id for doc_id, doc in prepared.items()
+            if stored.get(doc_id) != doc["hash"]
+        ]
+
+        for start in range(0, len(changed), self.batch_size):
+            batch_ids = changed[start:start + self.batch_size]
+            batch = [prepared[doc_id] for doc_id in batch_ids]
+            embeddings = self.embedding_model.encode(
+                [doc["content"] for doc in batch],
+                batch_size=self.batch_size
+            ).tolist()
+
+            self.collection.upsert(
+                documents=[doc["content"] for doc in batch],
+                embeddings=embeddings,
+                ids=batch_ids,
+                metadatas=[
+                    {
+                        "category": doc["category"],
+                        **(doc.get("metadata") or {}),
+                        "content_hash": doc["hash"],
+                        "source": source
+                    }
+                    for doc in batch
+                ]
+            )
+
+        removed = []
+        if prune:
+            removed = [doc_id for doc_id in previous if doc_id not in prepared]
+            for start in range(0, len(removed), self.batch_size):
+                self.collection.delete(ids=removed[start:start + self.batch_size])
+            manifest[source] = {doc_id: doc["hash"] for doc_id, doc in prepared.items()}
+            categories = {doc["category"] for doc in prepared.values()}
+        else:
+            manifest[source] = {
+                **previous,
+                **{doc_id: doc["hash"] for doc_id, doc in prepared.items()}
+            }
+            categories = {doc["category"] for doc in prepared.values()}
+            categories.update(manifest.get(self.CATEGORIES_KEY, {}).get(source, []))
+        self.record_categories(manifest, source, categories)
+
+        self.save_manifest(manifest)
+
+        added = sum(1 for doc_id in changed if doc_id not in stored)
+        return {
+            "added": added,
+            "updated": len(changed) - added,
+            "unchanged": len(prepared) - len(changed),
+            "deleted": len(removed)
+        }
@@ -0,0 +1,131 @@
+"""Versioned schema migrations for the Postgres database.
+
+Each migration is (version, description, statements). Database.migrate()
+applies the ones newer than the version recorded in schema_migrations, each
+in its own transaction. Append new migrations to the end; never edit one that
+has already shipped.
+"""
+
+MIGRATIONS = [
+    (1, "initial schema", [
+        # Statements use IF NOT EXISTS so databases created before
+        # migrations existed are adopted as-is
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY,
+            order_id VARCHAR(255) UNIQUE NOT NULL,
+            customer_email VARCHAR(255) NOT NULL,
+            amount DECIMAL(10, 2),
+            status VARCHAR(50) DEFAULT 'completed',
+            refund_requested BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS unhandled_emails (
+            id SERIAL PRIMARY KEY,
+            email_id VARCHAR(255) NOT NULL,
+            sender_email VARCHAR(255) NOT NULL,
+            subject VARCHAR(500),
+            body TEXT,
+            category VARCHAR(50),
+            importance VARCHAR(20),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS not_found_refunds (
+            id SERIAL PRIMARY KEY,
+            email_id VARCHAR(255) NOT NULL,
+            sender_email VARCHAR(255) NOT NULL,
+            subject VARCHAR(500),
+            body TEXT,
+            attempted_order_id VARCHAR(255),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS gmail_accounts (
+            id SERIAL PRIMARY KEY,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            access_token TEXT,
+            refresh_token TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS processed_emails (
+            id SERIAL PRIMARY KEY,
+            email_id VARCHAR(255) UNIQUE NOT NULL,
+            processed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+    ]),
+    (2, "sample orders for testing", [
+        """
+        INSERT INTO orders (order_id, customer_email, amount) VALUES
+            ('ORD001', 'customer1@example.com', 99.99),
+            ('ORD002', 'customer2@example.com', 149.50),
+            ('ORD003', 'customer3@example.com', 75.00)
+        ON CONFLICT (order_id) DO NOTHING
+        """,
+    ]),
+    (3, "notify the order cache when orders are added, removed or renamed", [
+        """
+        CREATE OR REPLACE FUNCTION notify_orders_changed() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP IN ('UPDATE', 'DELETE') THEN
+                PERFORM pg_notify('orders_changed', OLD.order_id);
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                PERFORM pg_notify('orders_changed', NEW.order_id);
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        "DROP TRIGGER IF EXISTS orders_changed ON orders",
+        """
+        CREATE TRIGGER orders_changed
+        AFTER INSERT OR DELETE OR UPDATE OF order_id ON orders
+        FOR EACH ROW EXECUTE FUNCTION notify_orders_changed()
+        """,
+    ]),
+    (4, "hot path indexes", [
+        # Retention pruning of processing history
+        """
+        CREATE INDEX IF NOT EXISTS idx_processed_emails_processed_at
+        ON processed_emails (processed_at)
+        """,
+    ]),
+    (5, "triage queue columns and keyset pagination indexes", [
+        "ALTER TABLE unhandled_emails ADD COLUMN IF NOT EXISTS account_email VARCHAR(255)",
+        "ALTER TABLE unhandled_emails ADD COLUMN IF NOT EXISTS resolved_at TIMESTAMP",
+        """
+        ALTER TABLE unhandled_emails ADD COLUMN IF NOT EXISTS importance_rank SMALLINT
+        GENERATED ALWAYS AS (
+            CASE importance WHEN 'high' THEN 3 WHEN 'medium' THEN 2 WHEN 'low' THEN 1 ELSE 0 END
+        ) STORED
+        """,
+        "ALTER TABLE not_found_refunds ADD COLUMN IF NOT EXISTS account_email VARCHAR(255)",
+        "ALTER TABLE not_found_refunds ADD COLUMN IF NOT EXISTS resolved_at TIMESTAMP",
+        """
+        CREATE INDEX IF NOT EXISTS idx_unhandled_emails_open_keyset
+        ON unhandled_emails (importance_rank DESC, created_at DESC, id DESC)
+        WHERE resolved_at IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_unhandled_emails_open_category_keyset
+        ON unhandled_emails (category, importance_rank DESC, created_at DESC, id DESC)
+        WHERE resolved_at IS NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_not_found_refunds_open_keyset
+        ON not_found_refunds (created_at DESC, id DESC)
+        WHERE resolved_at IS NULL
+        """,
+    ]),
+    (6, "persist access token expiry", [
+        "ALTER TABLE gmail_accounts ADD COLUMN IF NOT EXISTS token_expiry TIMESTAMP",
+    ]),
+]
@@ -0,0 +1,139 @@
+import base64
+import re
+from html.parser import HTMLParser
+from typing import Dict, Any
+
+MAX_BODY_CHARS = 20000  # text kept per message
+HTML_BYTES_PER_CHAR = 20  # raw HTML decoded per character of text kept
+
+_BLOCK_TAGS = {'p', 'div', 'br', 'tr', 'li', 'ul', 'ol', 'table', 'h1', 'h2', 'h3',
+               'h4', 'h5', 'h6', 'blockquote', 'pre', 'hr', 'section', 'article'}
+_SKIP_TAGS = {'script', 'style', 'head', 'title', 'noscript'}
+
+
+class _HTMLTextParser(HTMLParser):
+    def __init__(self, max_chars: int):
+        super().__init__(convert_charrefs=True)
+        self.max_chars = max_chars
+        self.chunks = []
+        self.length = 0
+        self.skip_depth = 0
+
+    @property
+    def full(self) -> bool:
+        return self.length >= self.max_chars
+
+    def _append(self, text: str):
+        if not self.full:
+            self.chunks.append(text)
+            self.length += len(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag in _SKIP_TAGS:
+            self.skip_depth += 1
+        elif tag in _BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in _SKIP_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag in _BLOCK_TAGS:
+            self._append("\n")
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self._append(data)
+
+
+def html_to_text(html: str, max_chars: int = MAX_BODY_CHARS) -> str:
+    """Convert HTML to plain text, stopping once max_chars have been collected"""
+    parser = _HTMLTextParser(max_chars)
+    step = 8192
+    for start in range(0, len(html), step):
+        parser.feed(html[start:start + step])
+        if parser.full:
+            break
+    parser.close()
+
+    text = "".join(parser.chunks)
+    text = re.sub(r'[ \t\r\f\v]+', ' ', text)
+    text = re.sub(r' *\n\s*', '\n', text)
+    return text.strip()[:max_chars]
+
+
+def _header(part: Dict[str, Any], name: str) -> str:
+    name = name.lower()
+    for header in part.get('headers', []):
+        if header.get('name', '').lower() == name:
+            return header.get('value', '')
+    return ''
+
+
+def _charset(part: Dict[str, Any]) -> str:
+    match = re.search(r'charset="?([\w.:-]+)"?', _header(part, 'Content-Type'), re.IGNORECASE)
+    return match.group(1) if match else 'utf-8'
+
+
+def _is_attachment(part: Dict[str, Any]) -> bool:
+    body = part.get('body', {})
+    return bool(
+        part.get('filename')
+        or body.get('attachmentId')
+        or _header(part, 'Content-Disposition').lower().startswith('attachment')
+    )
+
+
+def decode_part(part: Dict[str, Any], max_bytes: int) -> str:
+    """Decode a part's base64url body, reading at most max_bytes of it"""
+    data = part.get('body', {}).get('data')
+    if not data:
+        return ''
+
+    # 4 base64 characters encode 3 bytes, so only the needed prefix is decoded
+    data = data[:-(-max_bytes // 3) * 4]
+    data += '=' * (-len(data) % 4)
+    raw = base64.urlsafe_b64decode(data)
+
+    try:
+        return raw.decode(_charset(part), errors='replace')
+    except LookupError:
+        return raw.decode('utf-8', errors='replace')
+
+
+def extract_text(payload: Dict[str, Any], max_chars: int = MAX_BODY_CHARS) -> str:
+    """Extract readable text from a Gmail message payload
+
+    Walks nested multipart trees iteratively, skipping attachments. Inline
+    text/plain parts are preferred; HTML is converted to text only when a
+    message has no non-blank plain text. Output and decoding work are capped by max_chars.
+    """
+    plain = []
+    plain_length = 0
+    html_part = None
+
+    stack = [payload]
+    while stack and plain_length < max_chars:
+        part = stack.pop()
+        mime_type = part.get('mimeType', '').lower()
+
+        if mime_type.startswith('multipart/'):
+            # Reversed so parts are visited in document order
+            stack.extend(reversed(part.get('parts', [])))
+        elif _is_attachment(part):
+            continue
+        elif mime_type == 'text/plain':
+            text = decode_part(part, (max_chars - plain_length) * 4).strip()
+            if text:
+                plain.append(text)
+                plain_length += len(text)
+        elif mime_type == 'text/html' and html_part is None:
+            html_part = part
+
+    # Blank text/plain alternatives don't count, so HTML is used for them
+    if plain:
+        return "\n\n".join(plain)[:max_chars]
+    if html_part is not None:
+        html = decode_part(html_part, max_chars * HTML_BYTES_PER_CHAR)
+        return html_to_text(html, max_chars)
+    return ''
+
@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+"""
+Offline Replay Tool
+Streams a historical mailbox export (mbox or JSONL) through the
+categorize/handle pipeline, e.g. to backfill unhandled_emails after an outage
+or to evaluate a prompt change.
+"""
+
+import os
+import sys
+import json
+import time
+import email
+import mailbox
+import argparse
+import threading
+from email import policy
+from email.utils import parseaddr
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, Dict, Any
+from dotenv import load_dotenv
+from database import Database, WriteBehindBuffer
+from ai_agent import AIAgent
+from email_processor import EmailProcessor
+from mime_extractor import html_to_text, MAX_BODY_CHARS
+
+load_dotenv()
+
+class ReplyRecorder:
+    """Stands in for GmailClient and the write-behind buffer during dry runs
+    
+    Replies and the unhandled_emails/not_found_refunds rows that would have
+    been written are recorded to a file instead of reaching customers or the
+    triage queue.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, 'a', encoding='utf-8')
+
+    def send_reply(self, to_email, subject, body, account_email):
+        with self.lock:
+            self.file.write(json.dumps({
+                "to": to_email,
+                "subject": f"Re: {subject}",
+                "body": body,
+                "account": account_email
+            }) + "\n")
+            self.file.flush()
+        return True
+
+    def add(self, table, row):
+        with self.lock:
+            self.file.write(json.dumps({
+                "table": table,
+                **dict(zip(WriteBehindBuffer.COLUMNS[table], row))
+            }) + "\n")
+            self.file.flush()
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.file.close()
+
+def _mbox_body(message) -> str:
+    part = message.get_body(preferencelist=('plain', 'html'))
+    if part is None:
+        return ''
+    try:
+        content = part.get_content()
+    except (LookupError, UnicodeError):
+        content = part.get_payload(decode=True).decode('utf-8', errors='replace')
+    if part.get_content_type() == 'text/html':
+        return html_to_text(content[:MAX_BODY_CHARS * 20], MAX_BODY_CHARS)
+    return content[:MAX_BODY_CHARS]
+
+def iter_mbox(path: str, account: str, start: int = 0) -> Iterator[Dict[str, Any]]:
+    box = mailbox.mbox(path, factory=lambda f: email.message_from_binary_file(f, policy=policy.default), create=False)
+    for index, key in enumerate(box.iterkeys()):
+        if index < start:
+            continue
+        message = box[key]
+        message_id = message.get('Message-ID') or f"mbox-{index}"
+        yield {
+            'id': message_id.strip('<>'),
+            'thread_id': (message.get('In-Reply-To') or message_id).strip('<>'),
+            'subject': str(message.get('Subject', '')),
+            'sender': str(message.get('From', '')),
+            'body': _mbox_body(message),
+            'account': account or parseaddr(str(message.get('To', '')))[1]
+        }
+
+def iter_jsonl(path: str, account: str, start: int = 0) -> Iterator[Dict[str, Any]]:
+    with open(path, encoding='utf-8') as f:
+        lines = (line for line in f if line.strip())
+        for index, line in enumerate(lines):
+            if index < start:
+                continue
+            record = json.loads(line)
+            email_data = {
+                'id': str(record.get('id', f"jsonl-{index}")),
+                'thread_id': str(record.get('thread_id', record.get('id', f"jsonl-{index}"))),
+                'subject': record.get('subject', ''),
+                'sender': record.get('sender', ''),
+                'body': (record.get('body') or '')[:MAX_BODY_CHARS],
+                'account': account or record.get('account', '')
+            }
+            # Only Gmail API message ids can be matched against processed_emails
+            if record.get('id'):
+                email_data['gmail_id'] = str(record['id'])
+            yield email_data
+
+def iter_export(path: str, account: str = None, start: int = 0) -> Iterator[Dict[str, Any]]:
+    """Stream emails from an export, skipping the first start without parsing their bodies"""
+    if path.lower().endswith('.jsonl'):
+        return iter_jsonl(path, account, start)
+    return iter_mbox(path, account, start)
+
+class Replayer:
+    def __init__(self, processor: EmailProcessor, checkpoint_path: str,
+                 concurrency: int = 4, batch_size: int = 50, mark_processed: bool = True):
+        self.processor = processor
+        self.checkpoint_path = checkpoint_path
+        self.concurrency = concurrency
+        self.batch_size = batch_size
+        self.mark_processed = mark_processed
+        self.stats = {"processed": 0, "failed": 0}
+        self.failed = set()  # ids of emails that failed, kept in the checkpoint for --retry-failed
+
+    def load_checkpoint(self) -> int:
+        if not os.path.exists(self.checkpoint_path):
+            return 0
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        self.failed = set(checkpoint.get("failed_ids", []))
+        return checkpoint.get("offset", 0)
+
+    def save_checkpoint(self, offset: int):
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"offset": offset, **self.stats, "failed_ids": sorted(self.failed)}, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _process(self, email_data):
+        try:
+            self.processor.process_email(email_data)
+            return True
+        except Exception as e:
+            print(f"Failed to replay email {email_data['id']}: {e}")
+            return False
+
+    def _mark_processed(self, batch):
+        # Keep the live poll loop from handling replayed messages again. mbox
+        # exports only carry RFC Message-IDs, which the poll loop never sees.
+        gmail_ids = [(email_data['gmail_id'],) for email_data in batch if email_data.get('gmail_id')]
+        if not gmail_ids:
+            return
+        cursor = self.processor.db.conn.cursor()
+        cursor.executemany(
+            "INSERT INTO processed_emails (email_id) VALUES (%s) ON CONFLICT (email_id) DO NOTHING",
+            gmail_ids
+        )
+        self.processor.db.conn.commit()
+        cursor.close()
+
+    def run(self, emails_from, retry_failed: bool = False):
+        """Process emails in batches, checkpointing after every completed batch
+        
+        emails_from(offset) returns an iterator over the export starting at offset.
+        Emails that fail are recorded in the checkpoint; with retry_failed only
+        those are processed again, and the ones that succeed are cleared.
+        """
+        offset = self.load_checkpoint()
+        if retry_failed:
+            retrying = set(self.failed)
+            print(f"Retrying {len(retrying)} failed emails")
+            emails = (email_data for email_data in emails_from(0) if email_data['id'] in retrying)
+        else:
+            if offset:
+                print(f"Resuming after {offset} emails")
+            emails = emails_from(offset)
+
+        started = time.time()
+        replayed = 0
+        batch = []
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            def flush_batch():
+                nonlocal offset, replayed
+                results = list(pool.map(self._process, batch))
+                self.stats["processed"] += sum(results)
+                self.stats["failed"] += len(results) - sum(results)
+                for email_data, succeeded in zip(batch, results):
+                    if succeeded:
+                        self.failed.discard(email_data['id'])
+                    else:
+                        self.failed.add(email_data['id'])
+                if self.mark_processed:
+                    self._mark_processed(batch)
+                if not retry_failed:
+                    offset += len(batch)
+                replayed += len(batch)
+                self.save_checkpoint(offset)
+                elapsed = time.time() - started
+                print(f"Checkpoint at {offset} emails, {replayed / max(elapsed, 1e-9):.1f} emails/sec")
+
+            for email_data in emails:
+                batch.append(email_data)
+                if len(batch) >= self.batch_size:
+                    flush_batch()
+                    batch = []
+            if batch:
+                flush_batch()
+
+        elapsed = time.time() - started
+        print(f"\nReplay finished: {self.stats['processed']} processed, {self.stats['failed']} failed "
+              f"in {elapsed:.1f}s ({replayed / max(elapsed, 1e-9):.1f} emails/sec)")
+        if self.failed:
+            print(f"{len(self.failed)} failed emails are recorded in {self.checkpoint_path}; "
+                  f"re-run them with --retry-failed")
+        return self.stats
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Replay a mailbox export through the support pipeline")
+    parser.add_argument("path", help="Mailbox export (.mbox or .jsonl)")
+    parser.add_argument("--account", help="Account the emails were received on (default: To header / record)")
+    parser.add_argument("--concurrency", type=int, default=4, help="Emails processed in parallel")
+    parser.add_argument("--batch-size", type=int, default=50, help="Emails per checkpointed batch")
+    parser.add_argument("--checkpoint", help="Checkpoint file (default: <path>.checkpoint.json)")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Only re-process the emails the checkpoint records as failed")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Record would-be replies and unhandled/not-found records instead of sending and "
+                             "writing them, and don't flag refunds on orders")
+    parser.add_argument("--replies", default="replay_replies.jsonl",
+                        help="Where dry-run replies and records are written")
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    db = Database()
+    db.read_only_orders = args.dry_run
+    ai_agent = AIAgent(db)
+    if args.dry_run:
+        sender = ReplyRecorder(args.replies)
+        # Keep would-be triage rows out of the production queue
+        db.write_buffer.close()
+        db.write_buffer = sender
+    else:
+        from gmail_client import GmailClient
+        sender = GmailClient(db)
+        sender.load_accounts()
+
+    processor = EmailProcessor(db, sender, ai_agent)
+    replayer = Replayer(
+        processor,
+        checkpoint_path=args.checkpoint or f"{args.path}.checkpoint.json",
+        concurrency=args.concurrency,
+        batch_size=args.batch_size,
+        mark_processed=not args.dry_run
+    )
+
+    try:
+        replayer.run(lambda offset: iter_export(args.path, args.account, offset), retry_failed=args.retry_failed)
+    finally:
+        if args.dry_run:
+            sender.close()
+        db.write_buffer.flush()
+
+if __name__ == "__main__":
+    main()